@@ -0,0 +1,316 @@
+"""Benchmarks for the Tiny BASIC IL interpreter.
+
+Each case runs a BASIC workload on a headless interpreter, under Tiny BASIC
+(`tinybasic.il`) and TBX (`tbx.il`) where the dialect supports it, and
+reports:
+
+- the best time of several runs;
+- IL instructions per second, counting the instructions the plain IL
+  interpreter, without superinstructions or native expressions, executes
+  for the workload, so that the figure is comparable between engines and
+  optimizations;
+- BASIC lines per second, counting stored lines and direct statements;
+- peak memory allocated during a run, as seen by `tracemalloc`.
+
+Run this file with `--save FILE` to save the results as a baseline, and
+with `--compare FILE` to compare against one. Comparing exits with status 1
+if any case got slower by more than the tolerance.
+"""
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+import tinybasic
+
+
+EXAMPLES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Case:
+    """A benchmark workload.
+
+    `programs` maps each dialect the case supports to a program, or to a
+    list of direct statements if `direct` is set. `inputs` are fed to
+    INPUT; a case whose program only stops when it runs out of input sets
+    `until_input`.
+    """
+
+    def __init__(self, name, programs, inputs=(), direct=False,
+                 until_input=False):
+        self.name = name
+        self.programs = programs
+        self.inputs = inputs
+        self.direct = direct
+        self.until_input = until_input
+
+
+    def run(self, tb, dialect, max_steps=None):
+        """Run the case once on headless interpreter `tb`."""
+        program = self.programs[dialect]
+        if self.direct:
+            tb.reset(self.inputs)
+            tb.output = tinybasic.Output(discard)
+            tb.line_buffer_buffer = list(program)
+            tb.pc = tb.co_pc
+            tb.execute(max_steps)
+        else:
+            try:
+                tb.run(program, self.inputs, max_steps)
+            except tinybasic.BasicInputError:
+                if not self.until_input:
+                    raise
+
+
+    def lines(self, dialect):
+        """The number of direct statements in the case."""
+        return len(self.programs[dialect]) if self.direct else 0
+
+
+class CountingInterpreter(tinybasic.TinyBasicInterpreter):
+    """An interpreter that counts the stored lines it starts."""
+
+    def load_line(self, line_num):
+        self.lines_executed += 1
+        super().load_line(line_num)
+
+
+def discard(text):
+    pass
+
+
+def example(name):
+    with open(os.path.join(EXAMPLES_DIR, name)) as f:
+        return f.read()
+
+
+def sparse_program():
+    """A TBX loop that hops between far-apart lines of a large program."""
+    lines = ['10 LET I=0',
+             '20 GOTO 30000',
+             '30 LET I=I+1',
+             '40 IF I<3000 GOTO 20',
+             '50 END',
+             '30000 LET A=I',
+             '30010 GOTO 60000',
+             '60000 LET B=A',
+             '60010 GOTO 30']
+    lines += [f'{n} LET Z=0' for n in range(100, 65000, 31) if n % 10000]
+    return '\n'.join(lines)
+
+
+cases = [
+    Case('direct', {
+        'tb': ['LET A=A+1', 'LET B=A*2-B'] * 1000,
+        'tbx': ['LET A=A+1', 'LET B=A*2-B'] * 1000,
+    }, direct=True),
+    Case('statements', {
+        'tb': ['LET A=A+1', 'IF A<0 THEN LET A=0', 'LIST'] * 700,
+        'tbx': ['LET A=A+1', 'IF A<0 LET A=0', 'LST'] * 700,
+    }, direct=True),
+    Case('arithmetic', {
+        'tb': '''10 LET I=0
+20 LET S=0
+30 LET S=S+I*3-I/2
+40 LET I=I+1
+50 IF I<20000 THEN GOTO 30''',
+        'tbx': '''10 LET I=0
+20 LET S=0
+30 LET S=S+I*3-I/2
+40 LET I=I+1
+50 IF I<20000 GOTO 30''',
+    }),
+    Case('gosub', {
+        'tb': '''10 LET K=0
+20 LET N=0
+30 GOSUB 100
+40 LET K=K+1
+50 IF K<20 THEN GOTO 20
+60 END
+100 LET N=N+1
+110 IF N<500 THEN GOSUB 100
+120 RETURN''',
+        'tbx': '''10 LET K=0
+20 LET N=0
+30 GOSUB 100
+40 LET K=K+1
+50 IF K<20 GOTO 20
+60 END
+100 LET N=N+1
+110 IF N<500 GOSUB 100
+120 RET''',
+    }),
+    Case('for', {
+        'tbx': '''10 LET S=0
+20 FOR I=1 TO 200
+30 FOR J=1 TO 100
+40 LET S=S+J
+50 NXT J
+60 NXT I
+70 END''',
+    }),
+    Case('sparse', {'tbx': sparse_program()}),
+    Case('dim', {
+        'tbx': '''10 DIM A(60,60)
+20 FOR I=0 TO 60
+30 FOR J=0 TO 60
+40 LET A(I,J)=I*J
+50 NXT J
+60 NXT I
+70 LET S=0
+80 FOR I=0 TO 60
+90 FOR J=0 TO 60
+100 LET S=S+A(J,I)
+110 NXT J
+120 NXT I
+130 END''',
+    }),
+    Case('print', {
+        'tb': '''10 LET I=0
+20 PRINT I,I*I,"SQUARES"
+30 LET I=I+1
+40 IF I<3000 THEN GOTO 20''',
+        'tbx': '''10 LET I=0
+20 PR I;I*I;"SQUARES"
+30 LET I=I+1
+40 IF I<3000 GOTO 20''',
+    }),
+    Case('change', {'tb': example('change.bas')},
+         inputs=['42', '60', '5', '5', '100', '50', '99', '100'],
+         until_input=True),
+    Case('chomp', {'tbx': example('chomp.bas')},
+         inputs=['0', '2', '3', '3', '1,2', '2,1', '1,1', '0']),
+]
+
+
+def measure_startup(dialect, options, repeats):
+    """Time and trace the construction of an interpreter."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        tinybasic.headless_interpreter(dialect, **options)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    tinybasic.headless_interpreter(dialect, **options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': min(times), 'peak_memory': peak}
+
+
+def measure(case, dialect, options, repeats):
+    """Time, count and trace one case."""
+    counter = CountingInterpreter(**dict(tinybasic.dialects[dialect],
+                                         headless=True, cache_lines=False,
+                                         superinstructions=False,
+                                         native_expressions=False))
+    counter.lines_executed = 0
+    case.run(counter, dialect, max_steps=math.inf)
+    il_ops = counter.steps
+    lines = counter.lines_executed + case.lines(dialect)
+
+    tb = tinybasic.headless_interpreter(dialect, **options)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        case.run(tb, dialect)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+
+    tracemalloc.start()
+    case.run(tb, dialect)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'seconds': seconds, 'il_ops': il_ops, 'lines': lines,
+            'il_ops_per_sec': il_ops / seconds,
+            'lines_per_sec': lines / seconds, 'peak_memory': peak}
+
+
+def run_benchmarks(names=None, engine='il', repeats=3,
+                   superinstructions=True):
+    """Run the named cases, or all of them, and return the results by
+    'case/dialect'."""
+    options = {'engine': engine, 'superinstructions': superinstructions}
+    results = {}
+    for dialect in ('tb', 'tbx'):
+        if names is None or 'startup' in names:
+            results[f'startup/{dialect}'] = measure_startup(dialect, options,
+                                                            repeats)
+    if names is None or 'startup' in names:
+        # Start-up should not depend on the line number limit.
+        results['startup/big'] = measure_startup(
+            'tbx', dict(options, max_lines=2**24), repeats)
+    for case in cases:
+        if names is not None and case.name not in names:
+            continue
+        for dialect in case.programs:
+            results[f'{case.name}/{dialect}'] = measure(case, dialect, options,
+                                                        repeats)
+    return results
+
+
+def report(results, baseline=None, tolerance=0.1):
+    """Print results as a table, and return the keys of cases that are
+    slower than `baseline` by more than `tolerance`."""
+    regressions = []
+    print(f'{"case":<18}{"seconds":>10}{"IL ops/s":>14}{"lines/s":>12}'
+          f'{"peak KiB":>10}' + (f'{"vs base":>10}' if baseline else ''))
+    for key, result in results.items():
+        row = (f'{key:<18}{result["seconds"]:>10.4f}'
+               f'{result.get("il_ops_per_sec", 0):>14,.0f}'
+               f'{result.get("lines_per_sec", 0):>12,.0f}'
+               f'{result["peak_memory"] / 1024:>10,.0f}')
+        if baseline and key in baseline:
+            ratio = result['seconds'] / baseline[key]['seconds']
+            row += f'{ratio:>9.2f}x'
+            if ratio > 1 + tolerance:
+                regressions.append(key)
+                row += ' SLOWER'
+        print(row)
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Tiny BASIC benchmarks')
+    parser.add_argument('cases', nargs='*',
+                        help='cases to run (default: all); one of startup, '
+                             + ', '.join(case.name for case in cases))
+    parser.add_argument('-c', '--compile', action='store_true', default=False,
+                        help='use the compiled engine')
+    parser.add_argument('--no-superinstructions', action='store_true',
+                        default=False,
+                        help='run the IL without superinstructions')
+    parser.add_argument('-r', '--repeats', type=int, default=3,
+                        help='runs of each case, of which the best is kept')
+    parser.add_argument('--save', default=None,
+                        help='save the results as a baseline JSON file')
+    parser.add_argument('--compare', default=None,
+                        help='compare the results with a baseline JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown allowed before a case counts as a '
+                             'regression (default: 0.1)')
+    args = parser.parse_args()
+
+    engine = 'compiled' if args.compile else 'il'
+    results = run_benchmarks(args.cases or None, engine, args.repeats,
+                             not args.no_superinstructions)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'engine': engine,
+                       'superinstructions': not args.no_superinstructions,
+                       'python': sys.version,
+                       'results': results}, f, indent=2)
+    if regressions:
+        print(f'{len(regressions)} case(s) slower than the baseline: '
+              + ', '.join(regressions))
+        sys.exit(1)
@@ -0,0 +1,55 @@
+"""Tests for TBX arrays and the array cell allocator."""
+import pytest
+
+import tinybasic
+
+
+def run(program, **options):
+    tb = tinybasic.headless_interpreter('tbx', **options)
+    return tb, tb.run(program)
+
+
+def test_dim_and_store():
+    _, result = run('10 DIM A(3,2)\n20 LET A(2,1)=7\n30 LET B=A(2,1)')
+    assert result.variables['B'] == 7
+
+
+def test_out_of_bounds():
+    with pytest.raises(tinybasic.BasicError) as info:
+        run('10 DIM A(3)\n20 LET A(4)=1')
+    assert info.value.code == 11
+
+
+def test_cell_overflow():
+    with pytest.raises(tinybasic.BasicError) as info:
+        run('10 DIM A(3)\n20 LET A(1)=99999*99999*99999*99999')
+    assert info.value.code == 2
+
+
+def test_too_many_cells():
+    with pytest.raises(tinybasic.BasicError) as info:
+        run('10 DIM A(100)', max_array_cells=50)
+    assert info.value.code == 14
+
+
+def test_failed_redim_keeps_array():
+    tb = tinybasic.headless_interpreter('tbx', max_array_cells=50)
+    with pytest.raises(tinybasic.BasicError) as info:
+        tb.run('10 DIM A(10)\n20 LET A(4)=9\n30 DIM A(100)')
+    assert info.value.code == 14
+    assert tb.arrays()['A'][4] == 9
+    assert len(tb.basic_array_cells[0]) == 11
+
+
+def test_redim_within_limit():
+    tb, _ = run('10 DIM A(39)\n20 DIM A(39)\n30 DIM B(39)\n40 DIM A(4)',
+                max_array_cells=80)
+    assert tb.array_cells_used == 45
+
+
+def test_freed_cells_are_reused():
+    tb, _ = run('10 DIM A(10)\n20 DIM B(10)\n30 DIM A(2)\n40 DIM C(7)')
+    assert tb.basic_array_cells[0] == range(26, 29)
+    assert tb.basic_array_cells[2] == range(29, 37)
+    assert tb.free_cells == []
+    assert len(tb.basic_array_data) == 26 + 22
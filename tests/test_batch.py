@@ -0,0 +1,38 @@
+"""Tests for the batch runner."""
+import pytest
+
+import tinybasic
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_manifest_paths_with_spaces(tmp_path):
+    write(tmp_path / 'my prog.bas', '10 IN A\n20 PR A*2')
+    write(tmp_path / 'my input.txt', '21\n')
+    manifest = write(tmp_path / 'jobs.txt',
+                     '# programs\n\n'
+                     '"my prog.bas" \'my input.txt\'  # doubled\n')
+    jobs = tinybasic.find_jobs(manifest)
+    assert len(jobs) == 1
+    assert jobs[0]['name'] == str(tmp_path / 'my prog.bas')
+    assert jobs[0]['inputs'] == ['21']
+
+
+def test_manifest_extra_fields(tmp_path):
+    manifest = write(tmp_path / 'jobs.txt', 'my prog.bas in.txt\n')
+    with pytest.raises(ValueError, match='jobs.txt:1'):
+        tinybasic.find_jobs(manifest)
+
+
+def test_directory_jobs(tmp_path):
+    write(tmp_path / 'a.bas', '10 IN A\n20 PR A+1')
+    write(tmp_path / 'a.in', '41\n')
+    write(tmp_path / 'b.bas', '10 PR 1/0')
+    jobs = tinybasic.find_jobs(str(tmp_path))
+    results = list(tinybasic.run_batch(jobs, workers=2, threads=True))
+    assert [result['status'] for result in results] == ['done', 'error']
+    assert results[0]['output'].split() == ['42']
+    assert results[1]['code'] == 8
@@ -0,0 +1,91 @@
+"""Tests for checkpointing and resuming a run."""
+import os
+
+import pytest
+
+import tinybasic
+
+
+PROGRAM = '''10 DIM A(20)
+20 IN N
+30 FOR I=1 TO 300
+40 LET A(I/15)=A(I/15)+I*N+RN
+50 LET S=S+A(I/15)/7
+60 IF I/100*100=I GOSUB 200
+70 NXT I
+80 PR S;A(20)
+90 END
+200 PR I;S
+210 RET'''
+
+
+def start(seed=5, **options):
+    tb = tinybasic.headless_interpreter('tbx', seed=seed, **options)
+    out = []
+    tb.reset([7])
+    tb.output = tinybasic.Output(out.append)
+    tb.load_program(PROGRAM)
+    tb.start_program()
+    return tb, out
+
+
+def reference(**options):
+    return tinybasic.run(PROGRAM, [7], seed=5, **options).output
+
+
+@pytest.mark.parametrize('options', [{}, {'engine': 'compiled'},
+                                     {'superinstructions': False}])
+def test_resume_in_new_interpreter(tmp_path, options):
+    path = str(tmp_path / 'run.ckpt')
+    tb, out = start(**options)
+    resumes = 0
+    while tb.step(37) == 'step_limit':
+        tb.save_checkpoint(path)
+        resumed = tinybasic.headless_interpreter('tbx', **options)
+        resumed.inputs = tb.inputs
+        resumed.output = tb.output
+        resumed.load_checkpoint(path)
+        tb = resumed
+        resumes += 1
+    tb.output.flush()
+    assert resumes > 10
+    assert ''.join(out) == reference(**options)
+
+
+def test_appended_checkpoints(tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    tb, _ = start()
+    tb.step(200)
+    tb.save_checkpoint(path)
+    first = os.path.getsize(path)
+    tb.step(200)
+    tb.save_checkpoint(path)
+    assert os.path.getsize(path) < 2 * first
+    resumed = tinybasic.headless_interpreter('tbx')
+    resumed.load_checkpoint(path)
+    assert resumed.variables() == tb.variables()
+    assert resumed.arrays() == tb.arrays()
+    assert resumed.pc == tb.pc
+
+
+def test_torn_record_is_ignored(tmp_path):
+    path = str(tmp_path / 'run.ckpt')
+    tb, _ = start()
+    tb.step(200)
+    tb.save_checkpoint(path)
+    saved = tb.variables()
+    size = os.path.getsize(path)
+    tb.step(200)
+    tb.save_checkpoint(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size + (os.path.getsize(path) - size) // 2)
+    resumed = tinybasic.headless_interpreter('tbx')
+    resumed.load_checkpoint(path)
+    assert resumed.variables() == saved
+
+
+def test_not_a_checkpoint(tmp_path):
+    path = tmp_path / 'run.ckpt'
+    path.write_bytes(b'nonsense')
+    with pytest.raises(ValueError):
+        tinybasic.headless_interpreter('tbx').load_checkpoint(str(path))
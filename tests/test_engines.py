@@ -0,0 +1,80 @@
+"""Tests that the compiled engine agrees with the IL interpreter."""
+import os
+
+import pytest
+
+import tinybasic
+
+
+EXAMPLES_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def example(name):
+    with open(os.path.join(EXAMPLES_DIR, name)) as f:
+        return f.read()
+
+
+PROGRAMS = {
+    'arithmetic': ('tbx', '''10 LET S=0
+20 FOR I=1 TO 50
+30 LET S=S+I*3-I/2+(I-7)*(I+2)/5
+40 NXT I
+50 PR S;-S/3''', []),
+    'gosub': ('tbx', '''10 LET N=0
+20 GOSUB 100
+30 PR N
+40 END
+100 LET N=N+1
+110 IF N<20 GOSUB 100
+120 RET''', []),
+    'arrays': ('tbx', '''10 DIM A(5,4)
+20 FOR I=0 TO 5
+30 FOR J=0 TO 4
+40 LET A(I,J)=I*J
+50 NXT J
+60 NXT I
+70 PR A(3,4);A(5,2)''', []),
+    'input': ('tbx', '''10 IN A,B
+20 IF A>B PR "MORE"
+30 IF A<B PR "LESS"
+40 IF A=B PR "SAME"
+50 IF A<>0 GOTO 10''', ['3,4', '5,5', '7,2', '0,1']),
+    'print': ('tb', '''10 LET I=1
+20 PRINT I,I*I,"SQUARES"
+30 LET I=I+1
+40 IF I<6 THEN GOTO 20''', []),
+    'change': ('tb', example('change.bas'), ['42', '60', '5', '5']),
+    'chomp': ('tbx', example('chomp.bas'),
+              ['0', '2', '3', '3', '1,2', '2,1', '1,1', '0']),
+    # Too deeply nested for Python to compile; the line runs through the IL
+    'nested': ('tbx', '10 LET A=' + 'A+(' * 250 + '1' + ')' * 250
+               + '\n20 PR A\n30 LET B=A+1\n40 PR B', []),
+}
+
+
+def outcome(dialect, program, inputs, **options):
+    try:
+        result = tinybasic.run(program, inputs, dialect, **options)
+    except tinybasic.BasicError as e:
+        return type(e).__name__, e.code, e.line, e.output
+    return result.output, result.variables, result.arrays, result.status
+
+
+@pytest.mark.parametrize('name', sorted(PROGRAMS))
+def test_compiled_matches_il(name):
+    dialect, program, inputs = PROGRAMS[name]
+    assert (outcome(dialect, program, inputs, engine='compiled')
+            == outcome(dialect, program, inputs, engine='il'))
+
+
+@pytest.mark.parametrize('dialect, program', [
+    ('tbx', '10 PR 1/0'),
+    ('tbx', '10 DIM A(3)\n20 LET A(9)=1'),
+    ('tbx', '10 GOTO 99'),
+    ('tbx', '10 LET A=5\n20 IF A>2 LET B=Q(1)'),
+    # The IL divides before STORE finds the expression stack short
+    ('tb', '10 LET F=11*G/-19'),
+])
+def test_compiled_errors_match_il(dialect, program):
+    assert (outcome(dialect, program, [], engine='compiled')
+            == outcome(dialect, program, [], engine='il'))
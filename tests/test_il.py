@@ -0,0 +1,102 @@
+"""Tests for loading, linking and sharing the IL."""
+import marshal
+import threading
+
+import pytest
+
+import tinybasic
+
+
+def test_interpreters_share_the_image():
+    first = tinybasic.headless_interpreter('tbx')
+    second = tinybasic.headless_interpreter('tbx')
+    assert first.il_image is second.il_image
+    assert first.il_program[first.co_pc][0].__self__ is first
+    assert second.il_program[second.co_pc][0].__self__ is second
+
+
+def test_image_is_read_only():
+    image = tinybasic.headless_interpreter('tbx').il_image
+    with pytest.raises(TypeError):
+        image.labels['CO'] = 0
+    assert isinstance(image.instructions, tuple)
+
+
+def test_uncached_il_matches_cached():
+    cached = tinybasic.headless_interpreter('tbx')
+    uncached = tinybasic.headless_interpreter('tbx', cache_il=False)
+    assert uncached.il_image is not cached.il_image
+    assert uncached.il_fingerprint() == cached.il_fingerprint()
+    assert dict(uncached.il_labels) == dict(cached.il_labels)
+
+
+def test_threads_share_the_image():
+    program = '10 FOR I=1 TO 200\n20 LET S=S+I*{}\n30 NXT I\n40 PR S'
+    results = {}
+
+    def work(k):
+        results[k] = tinybasic.run(program.format(k)).output
+
+    threads = [threading.Thread(target=work, args=(k,)) for k in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {k: f'{20100 * k}\n' for k in range(8)}
+
+
+@pytest.fixture
+def il_file(tmp_path, monkeypatch):
+    """A copy of the TBX IL, with nothing for it cached in memory."""
+    monkeypatch.setattr(tinybasic, 'il_images', {})
+    monkeypatch.setattr(tinybasic, 'il_image_files', {})
+    path = tmp_path / 'tbx.il'
+    path.write_text(open(tinybasic.dialects['tbx']['il_code']).read())
+    return path
+
+
+def forget_images():
+    tinybasic.il_images.clear()
+    tinybasic.il_image_files.clear()
+
+
+def test_il_cache_is_written_and_used(il_file, monkeypatch):
+    first = tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    assert (il_file.parent / '__pycache__' / 'tbx.il.cache').exists()
+    forget_images()
+
+    def assemble(self, lines):
+        raise AssertionError('IL assembled again')
+
+    monkeypatch.setattr(tinybasic.TinyBasicInterpreter, 'load_interpreter',
+                        assemble)
+    second = tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    assert second.il_fingerprint() == first.il_fingerprint()
+    assert second.run('10 PR 6*7').output == '42\n'
+
+
+@pytest.mark.parametrize('contents', [
+    b'not marshal data',
+    marshal.dumps(('stale key', {}, ())),
+])
+def test_bad_il_cache_is_rebuilt(il_file, contents):
+    tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    cache_file = il_file.parent / '__pycache__' / 'tbx.il.cache'
+    good = cache_file.read_bytes()
+    cache_file.write_bytes(contents)
+    forget_images()
+    tb = tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    assert tb.run('10 PR 6*7').output == '42\n'
+    assert cache_file.read_bytes() == good
+
+
+def test_changed_il_is_assembled_again(il_file):
+    first = tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    il_file.write_text(il_file.read_text().replace("'PFL'", "'ZAP'"))
+    forget_images()
+    second = tinybasic.headless_interpreter('tbx', il_code=str(il_file))
+    assert second.il_fingerprint() != first.il_fingerprint()
+    with pytest.raises(tinybasic.BasicError) as info:
+        first.run('10 ZAP')
+    assert info.value.code == 12
+    assert second.run('10 ZAP').status == 'done'
@@ -0,0 +1,58 @@
+"""Tests for loading programs and program images."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import tinybasic
+
+
+TINYBASIC = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'tinybasic.py')
+
+
+def test_load_lines():
+    tb = tinybasic.headless_interpreter('tbx')
+    tb.load_lines(['20 PR 2\n', '\n', '10 PR 1\n', '30 PR 3\n', '30\n'])
+    assert tb.basic_lines == [10, 20]
+    assert tb.basic_program[10] == 'PR 1'
+
+
+def test_load_lines_rejects_direct_statements():
+    tb = tinybasic.headless_interpreter('tbx')
+    with pytest.raises(tinybasic.BasicSyntaxError):
+        tb.load_lines(['10 PR 1\n', 'RUN\n'])
+
+
+def test_load_lines_returns_direct_statements():
+    tb = tinybasic.headless_interpreter('tbx')
+    rest = tb.load_lines(['10 PR 1\n', 'RUN\n', '20 PR 2\n'], direct=True)
+    assert rest == ['RUN\n', '20 PR 2\n']
+    assert tb.basic_lines == [10]
+
+
+def test_file_with_run(tmp_path):
+    program = tmp_path / 'prog.bas'
+    program.write_text('10 PR 6*7\nRUN\n20 PR "MORE"\nRUN\n')
+    output = subprocess.run([sys.executable, TINYBASIC, '-x', '-f',
+                             str(program)], stdin=subprocess.DEVNULL,
+                            capture_output=True, text=True,
+                            check=True).stdout
+    assert output.count('42') == 2
+    assert 'MORE' in output
+
+
+@pytest.mark.parametrize('state', [False, True])
+def test_image_round_trip(tmp_path, state):
+    tb = tinybasic.headless_interpreter('tbx')
+    tb.run('10 DIM A(3)\n20 LET A(2)=7\n30 LET B=99999*99999*99999*99999')
+    path = str(tmp_path / 'prog.img')
+    tb.save_image(path, state=state)
+    loaded = tinybasic.headless_interpreter('tbx')
+    loaded.load_image(path)
+    assert loaded.basic_program == tb.basic_program
+    assert loaded.basic_lines == tb.basic_lines
+    if state:
+        assert loaded.variables() == tb.variables()
+        assert loaded.arrays() == tb.arrays()
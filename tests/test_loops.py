@@ -0,0 +1,54 @@
+"""Tests for TBX FOR loops."""
+import pytest
+
+import tinybasic
+
+
+ENGINES = [
+    {},
+    {'engine': 'compiled'},
+    {'superinstructions': False},
+    {'superinstructions': False, 'native_expressions': False,
+     'cache_lines': False},
+]
+
+
+@pytest.mark.parametrize('options', ENGINES)
+def test_for_after_goto_out_of_loop(options):
+    program = '''10 FOR I=1 TO 10
+20 IF I=2 GOTO 40
+30 NXT I
+40 LET K=K+1
+50 IF K<2000 GOTO 10
+60 PR K'''
+    result = tinybasic.run(program, dialect='tbx', **options)
+    assert result.output == '2000\n'
+
+
+@pytest.mark.parametrize('options', ENGINES)
+def test_nested_loops(options):
+    program = '''10 FOR I=1 TO 2
+20 FOR J=1 TO 2
+30 PR I*10+J
+40 NXT J
+50 NXT I'''
+    result = tinybasic.run(program, dialect='tbx', **options)
+    assert result.output == '11\n12\n21\n22\n'
+
+
+def test_for_replaces_inner_loops():
+    tb = tinybasic.headless_interpreter('tbx')
+    tb.run('''10 FOR I=1 TO 5
+20 FOR J=1 TO 5
+30 IF J=2 GOTO 10
+40 NXT J''', max_steps=5000)
+    assert len(tb.loop_stack) <= 2
+
+
+@pytest.mark.parametrize('options', ENGINES)
+def test_nxt_without_for(options):
+    program = '10 FOR I=1 TO 2\n20 NXT I\n30 NXT I'
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run(program, dialect='tbx', **options)
+    assert str(info.value) == 'NXT without FOR.'
+    assert info.value.line == 30
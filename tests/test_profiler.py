@@ -0,0 +1,53 @@
+"""Tests for profiling RUNs."""
+import tinybasic
+
+
+PROGRAM = ['10 FOR I=1 TO 50', '20 LET S=S+I', '30 NXT I']
+
+
+def session(lines):
+    out = []
+    tb = tinybasic.TinyBasicInterpreter(**dict(
+        tinybasic.dialects['tbx'], inputs=lines, output=out.append))
+    tb.execute()
+    tb.stop()
+    return ''.join(out)
+
+
+def test_profile_counts_lines():
+    tb = tinybasic.headless_interpreter('tbx')
+    profiler = tb.profile()
+    tb.run('\n'.join(PROGRAM))
+    summary = profiler.summary()
+    assert summary['lines'] == [{'line': 20, 'count': 50},
+                                {'line': 30, 'count': 50},
+                                {'line': 10, 'count': 1}]
+    opcodes = {entry['name']: entry['count']
+               for entry in summary['opcodes']}
+    assert opcodes['FOR'] == 1
+    assert opcodes['NEXT'] == 50
+    assert summary['instructions'] == sum(opcodes.values())
+    assert not profiler.running
+
+
+def test_on_finish():
+    tb = tinybasic.headless_interpreter('tbx')
+    finished = []
+    tb.profile(on_finish=finished.append)
+    tb.run('\n'.join(PROGRAM))
+    assert finished == [tb.profiler]
+
+
+def test_pfl_prints_report_after_run():
+    output = session(['PFL', *PROGRAM, 'RUN', 'PR S'])
+    report, _, rest = output.partition('BASIC line')
+    assert 'IL instructions in' in report
+    assert 'IL opcode' in report and 'IL label' in report
+    assert rest.split()[1:3] == ['20', '50']
+    assert '1275' in rest
+
+
+def test_pfl_again_stops_profiling():
+    output = session(['PFL', 'PFL', *PROGRAM, 'RUN', 'PR S'])
+    assert 'IL instructions in' not in output
+    assert '1275' in output
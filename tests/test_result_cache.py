@@ -0,0 +1,65 @@
+"""Tests for the on-disk result cache."""
+import pytest
+
+import tinybasic
+
+
+PROGRAM = '''10 LET A=A+1
+20 IF A<100 GOTO 10'''
+
+CONFIGS = [
+    {},
+    {'cache_lines': False},
+    {'superinstructions': False, 'native_expressions': False,
+     'cache_lines': False},
+    {'engine': 'compiled'},
+]
+
+
+def test_hit(tmp_path):
+    cache = tinybasic.ResultCache(str(tmp_path))
+    first = tinybasic.run(PROGRAM, cache=cache)
+    second = tinybasic.run(PROGRAM, cache=cache)
+    assert first == second
+    assert cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('options', CONFIGS)
+def test_not_shared_across_configs(tmp_path, options):
+    cache = tinybasic.ResultCache(str(tmp_path))
+    for other in CONFIGS:
+        tinybasic.run(PROGRAM, max_steps=200, cache=cache, **other)
+    expected = tinybasic.run(PROGRAM, max_steps=200, **options)
+    cached = tinybasic.run(PROGRAM, max_steps=200, cache=cache, **options)
+    assert cached == expected
+    assert cache.stats()['misses'] == len(CONFIGS)
+
+
+def test_timeout_counts_steps(tmp_path):
+    cache = tinybasic.ResultCache(str(tmp_path))
+    assert tinybasic.run(PROGRAM, cache=cache).steps is None
+    expected = tinybasic.run(PROGRAM, timeout=30)
+    cached = tinybasic.run(PROGRAM, timeout=30, cache=cache)
+    assert cached == expected
+    assert cached.steps > 0
+    assert cache.stats()['misses'] == 2
+
+
+def test_errors_are_cached(tmp_path):
+    cache = tinybasic.ResultCache(str(tmp_path))
+    for _ in range(2):
+        with pytest.raises(tinybasic.BasicError) as info:
+            tinybasic.run('10 PR 7\n20 PR 1/0', cache=cache)
+        assert info.value.code == 8
+        assert info.value.output == '7\n'
+    assert cache.stats()['hits'] == 1
+
+
+def test_unseeded_random_is_not_cached(tmp_path):
+    cache = tinybasic.ResultCache(str(tmp_path))
+    tinybasic.run('10 PR RN', cache=cache)
+    tinybasic.run('10 PR RN', cache=cache)
+    assert cache.stats()['hits'] == 0
+    tinybasic.run('10 PR RN', cache=cache, seed=1)
+    tinybasic.run('10 PR RN', cache=cache, seed=1)
+    assert cache.stats()['hits'] == 1
@@ -0,0 +1,53 @@
+"""Tests for the headless run() API."""
+import pytest
+
+import tinybasic
+
+
+def test_output_and_status():
+    result = tinybasic.run('10 IN X\n20 PR X*X\n30 END', inputs=[12])
+    assert result.output == '\n144\n\n'
+    assert result.status == 'end'
+    assert result.variables['X'] == 12
+
+
+def test_done_status():
+    assert tinybasic.run('10 LET A=1').status == 'done'
+
+
+def test_arrays_are_not_variables():
+    result = tinybasic.run('10 DIM A(2)\n20 LET A(1)=5\n30 LET B=3')
+    assert 'A' not in result.variables
+    assert result.variables['B'] == 3
+    assert result.arrays == {'A': [0, 5, 0]}
+
+
+def test_two_dimensional_arrays():
+    result = tinybasic.run('10 DIM A(2,3)\n20 LET A(1,2)=5')
+    assert result.arrays['A'][1][2] == 5
+
+
+def test_error_output():
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run('10 PR 7\n20 GOTO 99')
+    assert info.value.code == 7
+    assert info.value.output == '7\n'
+
+
+def test_not_a_numbered_line():
+    with pytest.raises(tinybasic.BasicSyntaxError):
+        tinybasic.run('PR 1')
+
+
+def test_tiny_basic_dialect():
+    result = tinybasic.run('10 LET A=6\n20 PRINT A*7', dialect='tb')
+    assert result.output.split() == ['42']
+
+
+@pytest.mark.parametrize('dialect, engine', [
+    ('tb', 'il'), ('tb', 'compiled'), ('tbx', 'il'), ('tbx', 'compiled'),
+])
+def test_variables_are_unbounded(dialect, engine):
+    program = '10 LET A=99999*99999\n20 LET A=A*A*A'
+    result = tinybasic.run(program, dialect=dialect, engine=engine)
+    assert result.variables['A'] == 99999 ** 6
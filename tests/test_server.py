@@ -0,0 +1,47 @@
+"""Tests for the interactive session server."""
+import asyncio
+import os
+
+import tinybasic
+
+
+async def session(path, lines, expect):
+    """Type `lines` into a new session and return its output once it
+    contains `expect`."""
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(''.join(f'{line}\n' for line in lines).encode())
+    await writer.drain()
+    output = ''
+    while expect not in output:
+        chunk = await reader.read(4096)
+        if not chunk:
+            break
+        output += chunk.decode()
+    writer.close()
+    return output
+
+
+async def serve_and_run(path):
+    server = asyncio.create_task(
+        tinybasic.serve(path=path, slice_steps=200))
+    while not os.path.exists(path):
+        await asyncio.sleep(0.01)
+    busy_reader, busy_writer = await asyncio.open_unix_connection(path)
+    busy_writer.write(b'10 GOTO 10\nRUN\n')
+    await busy_writer.drain()
+    try:
+        return await asyncio.wait_for(asyncio.gather(
+            session(path, ['10 IN A,B', '20 PR A*B', 'RUN', '6,7'], '42'),
+            session(path, ['10 IN X', '20 PR X+1', 'RUN', '99'], '100'),
+        ), timeout=30)
+    finally:
+        busy_writer.close()
+        server.cancel()
+
+
+def test_sessions_run_beside_a_busy_one(tmp_path):
+    path = str(tmp_path / 'tb.sock')
+    first, second = asyncio.run(serve_and_run(path))
+    assert first.startswith('\nTiny BASIC Extended')
+    assert '42' in first and '100' not in first
+    assert '100' in second and '42' not in second
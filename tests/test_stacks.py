@@ -0,0 +1,41 @@
+"""Tests for the bounded IL stacks."""
+import pytest
+
+import tinybasic
+
+
+def test_loops_do_not_use_expression_depth():
+    program = '''10 FOR I=1 TO 10
+20 IF I=2 GOTO 40
+30 NXT I
+40 LET K=K+1
+50 IF K<100 GOTO 10
+60 PR K'''
+    result = tinybasic.run(program, dialect='tbx', max_expression_depth=8)
+    assert result.output == '100\n'
+
+
+def test_expression_too_complex():
+    program = '10 PR ' + '(' * 40 + '1' + ')' * 40
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run(program, dialect='tbx', max_expression_depth=16,
+                      max_control_depth=16)
+    assert info.value.code == 5
+
+
+def test_subroutines_nested_too_deep():
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run('10 GOSUB 10', dialect='tbx', max_subroutine_depth=16)
+    assert info.value.code == 9
+
+
+@pytest.mark.parametrize('dialect, program', [
+    ('tbx', '10 GOSUB 30\n20 RET\n30 RET'),
+    ('tb', '10 RETURN'),
+])
+@pytest.mark.parametrize('engine', ['il', 'compiled'])
+def test_return_without_gosub(dialect, program, engine):
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run(program, dialect=dialect, engine=engine)
+    assert info.value.code == 10
+    assert str(info.value) == 'RET without GOSUB.'
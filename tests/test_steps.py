@@ -0,0 +1,53 @@
+"""Tests for step budgets."""
+import pytest
+
+import tinybasic
+
+
+PLAIN = {'cache_lines': False, 'superinstructions': False,
+         'native_expressions': False}
+
+PROGRAM = '''10 LET A=A+1
+20 IF A<100 GOTO 10'''
+
+
+def test_budget_stops_run():
+    result = tinybasic.run(PROGRAM, max_steps=50, **PLAIN)
+    assert result.status == 'step_limit'
+    assert result.steps == 50
+
+
+def test_plain_steps_are_il_instructions():
+    tb = tinybasic.headless_interpreter('tbx', **PLAIN)
+    tb.load_program(PROGRAM)
+    tb.start_program()
+    counted = []
+    tb.add_hook('op', lambda pc, op: counted.append(op))
+    assert tb.step(40) == 'step_limit'
+    assert len(counted) == 40
+
+
+def test_optimizations_run_further_on_a_budget():
+    plain = tinybasic.run(PROGRAM, max_steps=200, **PLAIN)
+    fast = tinybasic.run(PROGRAM, max_steps=200)
+    assert fast.variables['A'] > plain.variables['A']
+
+
+def test_steps_without_budget():
+    result = tinybasic.run(PROGRAM)
+    assert result.status == 'done'
+    assert result.steps is None
+
+
+def test_steps_with_timeout_only():
+    result = tinybasic.run(PROGRAM, timeout=60)
+    assert result.steps > 0
+
+
+def test_error_steps():
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run('10 PR 1/0', max_steps=100)
+    assert info.value.steps > 0
+    with pytest.raises(tinybasic.BasicError) as info:
+        tinybasic.run('10 PR 1/0')
+    assert info.value.steps is None
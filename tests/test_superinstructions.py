@@ -0,0 +1,50 @@
+"""Tests that superinstructions and keyword dispatch run the IL unchanged."""
+import pytest
+
+import tinybasic
+
+from test_engines import PROGRAMS, outcome
+
+
+@pytest.mark.parametrize('name', sorted(PROGRAMS))
+def test_fused_matches_plain(name):
+    dialect, program, inputs = PROGRAMS[name]
+    assert (outcome(dialect, program, inputs, superinstructions=True)
+            == outcome(dialect, program, inputs, superinstructions=False))
+
+
+@pytest.mark.parametrize('dialect, statements', [
+    ('tbx', ['LET A=1', 'PR A', 'pr a', 'IF A=1 PR "Y"', 'LST', 'XYZ',
+             'LE', 'FOR', 'GO TO', 'NXT', 'DIM A(', 'SZE']),
+    ('tb', ['LET A=1', 'PRINT A', 'IF A=1 THEN PRINT "Y"', 'LIST', 'XYZ',
+            'GOTO', 'RETURN', 'INPUT']),
+])
+def test_direct_statements(dialect, statements):
+    outcomes = []
+    for superinstructions in (True, False):
+        tb = tinybasic.headless_interpreter(
+            dialect, superinstructions=superinstructions)
+        outputs = []
+        for statement in statements:
+            out = []
+            tb.output = tinybasic.Output(out.append)
+            tb.line_buffer_buffer = [statement]
+            tb.user_quit = False
+            tb.pc = tb.co_pc
+            try:
+                tb.execute(10000)
+                outputs.append(''.join(out))
+            except Exception as e:
+                outputs.append((type(e).__name__, str(e)))
+        outcomes.append(outputs)
+    assert outcomes[0] == outcomes[1]
+
+
+def test_superinstructions_are_linked():
+    fused = tinybasic.headless_interpreter('tbx')
+    plain = tinybasic.headless_interpreter('tbx', superinstructions=False)
+    names = {handler.__name__ for handler, _ in fused.il_program}
+    assert {'il_tst_dispatch', 'il_icall_into', 'il_tstv_tst'} <= names
+    assert all(entry == base for entry, base
+               in zip(plain.il_program, plain.il_base_program)
+               if entry[0].__name__ != 'il_expr')
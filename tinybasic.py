@@ -8,43 +8,625 @@ interpreters written in IL.
 
 Run this file with the `-x` option for Tiny BASIC Extended (TBX).
 Run this file with the `-f` option to load a BASIC program on startup.
+Run this file with the `-c` option to compile programs to Python on RUN.
+Run this file with the `-o` option to write output to a file.
+Run this file with the `--profile` option to profile each RUN.
+Run this file with the `batch` command to run a directory of programs.
+
+To run a program from Python without a terminal, use `run()`.
+To run many programs in parallel, use `run_batch()` or the `batch` command.
+To serve interactive sessions over sockets, use `serve()` or the `serve`
+command.
 """
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import marshal
+import math
+import operator
+import os
 import random
 import re
+import shlex
+import sys
+import threading
+import time
+import types
+
+
+class BasicError(Exception):
+    """A BASIC error, raised instead of printed when running headless.
+
+    `code` is the TBX error number, if the error has one, and `line` is the
+    BASIC line being executed, or None in direct mode.
+    """
+
+    def __init__(self, message, code=None, line=None):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+        self.line = line
+
+
+class BasicSyntaxError(BasicError):
+    """A line that the BASIC interpreter could not parse."""
+
+
+class BasicInputError(BasicError):
+    """An INPUT that was not a number, or ran out of input."""
+
+
+# BasicError and its subclasses by name; see `ResultCache`.
+basic_errors = {error.__name__: error for error in
+                (BasicError, BasicSyntaxError, BasicInputError)}
+
+
+class StackOverflow(Exception):
+    """Raised when a push would exceed a stack's maximum depth."""
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+# Bump when the assembled IL format changes, to invalidate cached IL.
+IL_CACHE_VERSION = 1
+
+# Assembled IL programs as ILImages, by cache key and by IL file, as
+# (path, modification time, size); see `TinyBasicInterpreter.load_il()`.
+il_images = {}
+il_image_files = {}
+
+# How to link each IL program with each set of interpreter options, by IL
+# fingerprint and options; see `TinyBasicInterpreter.plan_program()`.
+# Entries are only ever added, and two threads adding the same one add
+# equal plans.
+il_link_plans = {}
+
+
+class ILImage:
+    """An assembled IL program, shared by the interpreters that load it.
+
+    `labels` maps label names to instruction indices, and `instructions`
+    holds (opcode, operands) pairs. An image is read-only, so interpreters
+    in any number of threads can share one without locking. Each
+    interpreter binds the instructions to its own handlers; see
+    `TinyBasicInterpreter.link_interpreter()`.
+    """
+
+    def __init__(self, labels, instructions):
+        self.labels = types.MappingProxyType(dict(labels))
+        self.instructions = tuple(instructions)
+        self.opcodes = (tuple(op for op, _ in self.instructions)
+                        + ('LINE', 'RUN'))
+        self.fingerprint = hashlib.sha256(
+            repr(self.instructions).encode()).hexdigest()
+
+
+# The start of a program image file, and the version of its format; see
+# `TinyBasicInterpreter.save_image()`.
+PROGRAM_IMAGE_MAGIC = b'TBIMAGE\n'
+PROGRAM_IMAGE_VERSION = 2
+
+# The start of a checkpoint file, the version of its format, and the size
+# in bytes of the blocks of array cells it saves; see
+# `TinyBasicInterpreter.save_checkpoint()`.
+CHECKPOINT_MAGIC = b'TBCHKPT\n'
+CHECKPOINT_VERSION = 2
+CHECKPOINT_BLOCK_SIZE = 2**15
+
+# Bump when what `ResultCache` records changes, to invalidate old entries.
+RESULT_CACHE_VERSION = 3
+
+# Events that hooks can be added for; see
+# `TinyBasicInterpreter.add_hook()`.
+HOOK_EVENTS = ('line', 'op', 'gosub', 'return', 'store', 'error')
+
+
+class InputNeeded(Exception):
+    """Raised by an `InputQueue` with no lines to read yet."""
+
+
+class InputQueue:
+    """Lines of input that arrive while a program runs.
+
+    Pass one as `inputs` to let the interpreter wait for input without
+    blocking: reading from an empty queue raises `InputNeeded`, which
+    makes `execute()` return 'input', ready to carry on from the same
+    instruction once `put()` has added a line. Reading from an empty queue
+    after `close()` is the end of input.
+    """
+
+    def __init__(self):
+        self.lines = collections.deque()
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.lines:
+            return self.lines.popleft()
+        if self.closed:
+            raise StopIteration
+        raise InputNeeded
+
+    def put(self, line):
+        self.lines.append(line)
+
+    def close(self):
+        self.closed = True
+
+
+class LoopChanged(Exception):
+    """Raised by an instruction that changes how `execute()` has to run,
+    to make it choose its loop again."""
+
+
+class BreakpointHit(Exception):
+    """Raised when execution reaches a stored line with a breakpoint, once
+    the line is ready to run."""
+
+
+class BadSubscript(Exception):
+    """Raised by a native expression with an array subscript out of range."""
+
+
+class Stack(list):
+    """An IL stack with a maximum depth.
+
+    Values are pushed and popped at the end of the underlying list, but
+    indexing counts from the top, so `stack[0]` is the most recently pushed
+    value. `push()` checks the depth limit and raises `StackOverflow` with
+    the IL error code for this stack; instructions that pop before pushing
+    can use `append()`, which cannot grow the stack past its limit.
+    """
+
+    def __init__(self, max_depth, error_code):
+        super().__init__()
+        self.max_depth = max_depth
+        self.error_code = error_code
+
+    def __getitem__(self, i):
+        return super().__getitem__(-1 - i)
+
+    def __setitem__(self, i, value):
+        super().__setitem__(-1 - i, value)
+
+    def push(self, value):
+        if len(self) >= self.max_depth:
+            raise StackOverflow(self.error_code)
+        self.append(value)
+
+
+class LineBuffer:
+    """A line of BASIC text with a read position.
+
+    The lexing instructions used to strip and slice the line buffer string
+    as they went; this keeps the text as it was read and moves `pos`
+    instead. `end` drops trailing whitespace after the first `strip()`, as
+    stripping the string did, and an upper-case copy for keyword tests is
+    made at most once per line.
+    """
+
+    def __init__(self, text=''):
+        self.reset(text)
+
+    def reset(self, text):
+        self.text = text
+        self.pos = 0
+        self.end = len(text)
+        self.stripped = False
+        self.upper = None
+
+    def __str__(self):
+        return self.text[self.pos:self.end]
+
+    def strip(self):
+        """Skip leading whitespace, and the first time, trailing whitespace."""
+        text = self.text
+        if not self.stripped:
+            self.end = len(text.rstrip())
+            self.stripped = True
+        pos = self.pos
+        end = self.end
+        while pos < end and text[pos].isspace():
+            pos += 1
+        self.pos = pos
+
+    def is_blank(self):
+        pos = self.pos
+        while pos < self.end and self.text[pos].isspace():
+            pos += 1
+        return pos >= self.end
+
+    def at_end(self):
+        return self.pos >= self.end
+
+    def startswith(self, s):
+        return self.text.startswith(s, self.pos, self.end)
+
+    def match(self, test_str):
+        """Strip, then consume `test_str` if the line starts with it,
+        ignoring case. A carriage return matches the end of the line."""
+        self.strip()
+        if test_str == '\r' and self.pos >= self.end:
+            return True
+        upper = self.upper
+        if upper is None:
+            upper = self.text.upper()
+            # Some characters upper-case to more than one character, in
+            # which case positions in the copy are of no use.
+            self.upper = upper = upper if len(upper) == len(self.text) else ''
+        if upper:
+            matched = upper.startswith(test_str, self.pos, self.end)
+        else:
+            matched = self.text[self.pos:self.end].upper().startswith(test_str)
+        if matched:
+            self.pos += len(test_str)
+        return matched
+
+    def variable(self, array=False):
+        """Strip, then consume a variable name and return its index, or
+        return None. With `array`, the name must be followed by '('."""
+        self.strip()
+        pos = self.pos
+        if pos < self.end:
+            v = self.text[pos]
+            if v.isalpha() and (not array or (pos + 1 < self.end
+                                              and self.text[pos + 1] == '(')):
+                self.pos = pos + 1
+                return ord(v.upper()) - ord('A')
+        return None
+
+    def function(self):
+        """Strip, then test for a two-letter function name."""
+        self.strip()
+        return (self.end - self.pos >= 2
+                and self.text[self.pos:self.pos + 2].isalpha())
+
+    def digits(self):
+        """Strip, then consume and return a run of digits."""
+        self.strip()
+        text = self.text
+        start = pos = self.pos
+        while pos < self.end and text[pos].isdigit():
+            pos += 1
+        self.pos = pos
+        return text[start:pos]
+
+    def partition(self, sep):
+        """Consume and return the text up to `sep`, and `sep` itself."""
+        i = self.text.find(sep, self.pos, self.end)
+        if i < 0:
+            i = self.end
+        head = self.text[self.pos:i]
+        self.pos = i + 1
+        return head
+
+
+class Output:
+    """Buffered interpreter output.
+
+    Writes are collected until one ends with a newline, or `flush()` is
+    called, and then passed on to the sink as a single string. The sink is
+    a file-like object, a callable taking a string, or None for whatever
+    `sys.stdout` is at the time.
+    """
+
+    def __init__(self, sink=None):
+        self.sink = sink
+        self.parts = []
+        if sink is None or hasattr(sink, 'write'):
+            self.sink_write = None
+        else:
+            self.sink_write = sink
+
+    def write(self, text):
+        self.parts.append(text)
+        if text.endswith('\n'):
+            self.emit()
+
+    def emit(self):
+        """Pass buffered text on to the sink."""
+        if self.parts:
+            text = ''.join(self.parts)
+            self.parts.clear()
+            if self.sink_write is not None:
+                self.sink_write(text)
+            else:
+                (self.sink or sys.stdout).write(text)
+
+    def flush(self):
+        """Pass buffered text on to the sink and flush the sink."""
+        self.emit()
+        if self.sink_write is None:
+            (self.sink or sys.stdout).flush()
+
+
+class Profiler:
+    """Counts and times IL instructions and BASIC lines during a RUN.
+
+    `opcodes` and `labels` give the opcode, and the nearest IL label at or
+    before it, of each instruction in the interpreter's unfused
+    `il_base_program`. With `sample` above 1, about one in `sample`
+    instructions, chosen at random intervals, is counted and timed, and
+    instruction figures are scaled up to match. `on_finish` is called with
+    the profiler when a RUN ends.
+    """
+
+    def __init__(self, opcodes, labels, sample=1, on_finish=None):
+        self.opcodes = opcodes
+        self.labels = labels
+        self.sample = sample
+        self.on_finish = on_finish
+        self.random = random.Random()
+        self.counts = [0 for _ in opcodes]
+        self.times = [0 for _ in opcodes]
+        self.line_counts = collections.Counter()
+        self.running = False
+
+
+    def start(self):
+        """Start profiling a RUN, forgetting any earlier one."""
+        self.counts[:] = [0 for _ in self.opcodes]
+        self.times[:] = [0 for _ in self.opcodes]
+        self.line_counts.clear()
+        self.running = True
+
+
+    def finish(self):
+        self.running = False
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+
+    def execute(self, tb, stop_steps, deadline):
+        """The loop of `execute()` while profiling."""
+        il_program = tb.il_base_program
+        counts = self.counts
+        times = self.times
+        clock = time.perf_counter_ns
+        sample = self.sample
+        next_sample = tb.steps + 1
+        while not tb.user_quit:
+            if tb.steps >= stop_steps:
+                return 'step_limit'
+            if time.monotonic() >= deadline:
+                return 'time_limit'
+            steps = tb.steps
+            chunk_end = min(steps + 1000, stop_steps)
+            try:
+                while steps < chunk_end and not tb.user_quit:
+                    pc = tb.pc
+                    handler, args = il_program[pc]
+                    tb.pc = pc + 1
+                    steps += 1
+                    if steps >= next_sample:
+                        if sample > 1:
+                            next_sample = steps + self.random.randint(
+                                1, 2 * sample - 1)
+                        start = clock()
+                        handler(*args)
+                        times[pc] += clock() - start
+                        counts[pc] += 1
+                    else:
+                        handler(*args)
+            finally:
+                tb.steps = steps
+        return None
+
+
+    def summary(self):
+        """Return the profile as a dict, with instructions by opcode and
+        by label sorted by time and lines sorted by count."""
+        def totals(keys):
+            by_key = {}
+            for key, count, ns in zip(keys, self.counts, self.times):
+                if count:
+                    total = by_key.setdefault(key, [0, 0])
+                    total[0] += count * self.sample
+                    total[1] += ns * self.sample / 1e9
+            return [{'name': key, 'count': count, 'seconds': seconds}
+                    for key, (count, seconds)
+                    in sorted(by_key.items(), key=lambda item: -item[1][1])]
+
+        opcodes = totals(self.opcodes)
+        return {
+            'sample': self.sample,
+            'instructions': sum(entry['count'] for entry in opcodes),
+            'seconds': sum(entry['seconds'] for entry in opcodes),
+            'opcodes': opcodes,
+            'labels': totals(self.labels),
+            'lines': [{'line': line, 'count': count}
+                      for line, count in self.line_counts.most_common()],
+        }
+
+
+    def report(self, limit=20):
+        """Return the profile as text, with at most `limit` rows per table."""
+        summary = self.summary()
+        total = summary['seconds'] or 1
+        text = [f'{summary["instructions"]} IL instructions in '
+                f'{summary["seconds"]:.3f}s'
+                + (f' (sampled 1 in {self.sample})' if self.sample > 1
+                   else '')]
+        for title, entries in (('IL opcode', summary['opcodes']),
+                               ('IL label', summary['labels'])):
+            text.append(f'{title:<12}{"count":>12}{"seconds":>10}{"%":>7}')
+            for entry in entries[:limit]:
+                text.append(f'{entry["name"]:<12}{entry["count"]:>12}'
+                            f'{entry["seconds"]:>10.4f}'
+                            f'{100 * entry["seconds"] / total:>7.1f}')
+        text.append(f'{"BASIC line":<12}{"count":>12}')
+        for entry in summary['lines'][:limit]:
+            text.append(f'{entry["line"]:<12}{entry["count"]:>12}')
+        return '\n'.join(text) + '\n'
 
 
 class TinyBasicInterpreter:
 
+    # Operands taken by each IL instruction, by kind. Instructions not listed
+    # take no operands.
+    il_operands = {
+        'ERR': ('int',),
+        'HOP': ('label',),
+        'ICALL': ('label',),
+        'IJMP': ('label',),
+        'LIT': ('int',),
+        'TST': ('label', 'str'),
+        'TSTA': ('label',),
+        'TSTF': ('label',),
+        'TSTL': ('label',),
+        'TSTN': ('label',),
+        'TSTV': ('label',),
+    }
+
+    # Labels of the IL subroutines that parse and evaluate an expression
+    expression_labels = ('EXPR', 'EXPR1')
+
+    # Runs of IL instructions that `fuse_instructions()` replaces with one
+    # superinstruction, by the name of its handler. A handler takes the
+    # operands of the whole run and leaves `pc` where the run would.
+    il_superinstructions = {
+        ('TSTV', 'IND', 'RTN'): 'il_tstv_ind_rtn',
+        ('TSTN', 'RTN'): 'il_tstn_rtn',
+        ('TSTV', 'TST'): 'il_tstv_tst',
+        ('TST', 'ICALL'): 'il_tst_icall',
+        ('DONE', 'NXT'): 'il_done_nxt',
+    }
+
+    # TBX error messages, by error code
+    error_messages = {
+        1: 'Line too long.',
+        2: 'Numeric overflow.',
+        3: 'Illegal character.',
+        4: 'Unclosed quote.',
+        5: 'Expression too complex.',
+        6: 'Illegal expression.',
+        7: 'Invalid line number.',
+        8: 'Division by zero.',
+        9: 'Subroutines nested too deep.',
+        10: 'RET without GOSUB.',
+        11: 'Illegal variable.',
+        12: 'Bad command or statement name.',
+        13: 'Unmatched parentheses.',
+        14: 'OOM',
+    }
+
     def __init__(self, il_code='tinybasic.il', max_lines=256,
                  greeting='Tiny BASIC\n\n',
                  command_prompt='? ', input_prompt='> ',
-                 enable_multistatement=False, autoload=[]):
+                 enable_multistatement=False, autoload=[],
+                 max_expression_depth=1024, max_control_depth=1024,
+                 max_subroutine_depth=1024, cache_lines=True, engine='il',
+                 output=None, inputs=None, headless=False, cache_il=True,
+                 max_array_cells=2**22, superinstructions=True,
+                 native_expressions=True, seed=None):
         self.pc = 0
         self.il_program = []
         self.il_labels = {}
+        self.il_image = None
 
-        self.line_buffer = ''
+        self.line_buffer = LineBuffer()
         self.line_buffer_buffer = autoload
         self.innum_buffer = []
         self.max_lines = max_lines
         self.basic_linenum = 0
-        self.basic_program = ['' for _ in range(max_lines)]
+        # Stored lines by line number, and the sorted line numbers in use.
+        # Nothing here is sized by max_lines, which only bounds line numbers.
+        self.basic_program = {}
+        self.basic_lines = []
         self.basic_var_data = [0 for _ in range(26)]
+        # TBX array cells as 64-bit integers, by the indices that array
+        # variables hold. Indices start after the variables', so the first
+        # 26 cells are unused.
+        self.basic_array_data = array.array('q', bytes(8 * 26))
         self.basic_array_widths = [0 for _ in range(26)]
-        self.listing_range = [n for n in range(max_lines)]
-
-        self.expression_stack = []
-        self.control_stack = []
-        self.subroutine_stack = []
+        # Arrays by variable index, as (base index, dimensions), and the
+        # cells of each variable's array, for bounds checks
+        self.basic_arrays = {}
+        self.basic_array_cells = [range(0) for _ in range(26)]
+        # Unused runs of array cells, as ranges sorted by start, and the
+        # number of cells in use; see `allocate_array()`.
+        self.free_cells = []
+        self.array_cells_used = 0
+        self.max_array_cells = max_array_cells
+        # What the last checkpoint saved; see `save_checkpoint()`.
+        self.checkpoint_path = None
+        self.checkpoint_base = None
+        # Where TBX's RN gets random numbers: the random module, or a
+        # generator of this interpreter's own if given a seed, which
+        # `reset()` seeds again.
+        self.seed = seed
+        self.random = random if seed is None else random.Random(seed)
+        self.listing_range = range(max_lines)
+
+        # Pre-parsed actions for stored lines, keyed by line number; () marks
+        # a line that has to go through the IL every time.
+        self.cache_lines = cache_lines
+        self.line_cache = {}
+        self.line_actions = ()
+        # Expressions are evaluated by Python functions rather than the IL,
+        # cached by line text, position and subroutine; see
+        # `native_expression()`.
+        self.native_expressions = native_expressions
+        self.expression_cache = {}
+
+        # With the 'compiled' engine, RUN compiles the stored program into
+        # one Python function per line; see `compile_program()`.
+        if engine not in ('il', 'compiled'):
+            raise ValueError(f'Unknown engine {engine!r}.')
+        self.engine = engine
+        self.compiled_lines = None
+        # Run common IL sequences as superinstructions, and chains of
+        # keyword tests through a lookup; see `fuse_instructions()` and
+        # `index_keywords()`.
+        self.superinstructions = superinstructions
+
+        # Overflow raises TBX error 5 (expression too complex) or 9
+        # (subroutines nested too deep).
+        self.expression_stack = Stack(max_expression_depth, 5)
+        self.control_stack = Stack(max_control_depth, 5)
+        self.subroutine_stack = Stack(max_subroutine_depth, 9)
+        # TBX FOR loops, innermost first, as (variable, limit, first line of
+        # body). There is at most one loop per variable, so this cannot
+        # overflow; see `il_for()`.
+        self.loop_stack = Stack(26, None)
 
         self.user_quit = False
-
-        with open(il_code, 'r') as f:
-            self.load_interpreter(f.readlines())
+        self.exit_status = None
+        # Steps executed by `execute()` with a budget; see `execute()`.
+        # While it is counting, compiled lines go back to it after every
+        # line.
+        self.steps = 0
+        self.counting_steps = False
+        # While profiling, every line goes through the IL; see `profile()`.
+        self.profiler = None
+        # Hooks by event, or None if there are none, and the unfused IL
+        # with handlers that call them; see `add_hook()`.
+        self.hooks = None
+        self.hooked_program = None
+        # Lines at which `step()` and `run_until()` stop; lines with a
+        # breakpoint are never compiled. See `set_breakpoints()`.
+        self.breakpoints = frozenset()
+        # The BasicError that made `step()` return 'error'.
+        self.error = None
 
         self.greeting = greeting
         self.command_prompt = command_prompt
         self.input_prompt = input_prompt
+        self.enable_multistatement = enable_multistatement
+        self.output = output if isinstance(output, Output) else Output(output)
+        # Lines to read instead of standard input. A headless interpreter
+        # raises BasicError instead of printing error messages, and stops
+        # instead of prompting for a command once `autoload` is used up.
+        self.inputs = None if inputs is None else iter(inputs)
+        self.awaiting_input = False
+        self.headless = headless
 
         self.il_ops = {}
         self.il_ops['ADD'] = self.il_add
@@ -80,6 +662,7 @@ class TinyBasicInterpreter:
         self.il_ops['NLINE'] = self.il_nline
         self.il_ops['PRN'] = self.il_prn
         self.il_ops['PRS'] = self.il_prs
+        self.il_ops['PROFILE'] = self.il_profile    # TBX
         self.il_ops['RANDOM'] = self.il_random      # TBX
         self.il_ops['RSTR'] = self.il_rstr
         self.il_ops['RTN'] = self.il_rtn
@@ -88,6 +671,7 @@ class TinyBasicInterpreter:
         self.il_ops['SPC'] = self.il_spc
         self.il_ops['SPCONE'] = self.il_spcone      # TBX
         self.il_ops['STORE'] = self.il_store
+        self.il_ops['STOREV'] = self.il_storev      # TBX
         self.il_ops['SUB'] = self.il_sub
         self.il_ops['TAB'] = self.il_tab            # TBX
         self.il_ops['TST'] = self.il_tst
@@ -99,9 +683,74 @@ class TinyBasicInterpreter:
         self.il_ops['XINIT'] = self.il_xinit
         self.il_ops['XFER'] = self.il_xfer
 
+        self.load_il(il_code, cache_il)
+
+
+    def load_il(self, il_code, use_cache=True):
+        """Load the IL program in file `il_code`.
+
+        Assembled programs are kept in memory as ILImages for other
+        interpreters, and on disk in a `__pycache__` directory next to the
+        IL file, keyed by a hash of the IL source and `IL_CACHE_VERSION`.
+        Either copy is used instead of assembling the source again while
+        the key matches. An image in memory is also found by the path,
+        modification time and size of the IL file, without reading it.
+        """
+        if use_cache:
+            stat = os.stat(il_code)
+            file_key = (os.path.abspath(il_code), stat.st_mtime_ns,
+                        stat.st_size)
+            image = il_image_files.get(file_key)
+            if image is not None:
+                self.link_interpreter(image)
+                return
+        with open(il_code, 'rb') as f:
+            source = f.read()
+        if not use_cache:
+            self.load_interpreter(source.decode().splitlines(keepends=True))
+            return
+        key = hashlib.sha256(b'%d:%s' % (IL_CACHE_VERSION, source)).hexdigest()
+        image = il_images.get(key)
+        cache_dir = os.path.join(os.path.dirname(il_code), '__pycache__')
+        cache_file = os.path.join(cache_dir,
+                                  f'{os.path.basename(il_code)}.cache')
+        if image is None:
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached_key, labels, instructions = marshal.loads(f.read())
+                if cached_key == key:
+                    image = ILImage(labels, instructions)
+            except (OSError, EOFError, ValueError, TypeError):
+                pass
+        if image is None:
+            self.load_interpreter(source.decode().splitlines(keepends=True))
+            image = self.il_image
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                temp_file = (f'{cache_file}.{os.getpid()}.'
+                             f'{threading.get_ident()}')
+                with open(temp_file, 'wb') as f:
+                    f.write(marshal.dumps((key, dict(image.labels),
+                                           image.instructions)))
+                os.replace(temp_file, cache_file)
+            except OSError:
+                pass
+        else:
+            self.link_interpreter(image)
+        il_images[key] = image
+        il_image_files[file_key] = image
+
 
     def load_interpreter(self, lines):
-        for ln in lines:
+        """Parse, assemble and verify an IL program.
+
+        Labels are resolved to instruction indices and literal operands are
+        converted here, once, so that `start()` only has to call pre-bound
+        handlers with ready-made arguments.
+        """
+        self.il_labels = {}
+        statements = []
+        for ln_num, ln in enumerate(lines, start=1):
             bareln = ln.split(';', maxsplit=1)[0].strip()
             match = re.fullmatch(r'(?P<label>\w+:)?\s*(?P<instr>\w+)?\s*(?P<op1>[^,]+)?,?(?P<op2>.+)?', bareln)
             label = match.group('label')
@@ -109,39 +758,232 @@ class TinyBasicInterpreter:
             op1 = match.group('op1')
             op2 = match.group('op2')
             if instr is not None:
-                stmt = [instr]
+                operands = []
                 if op1 is not None:
-                    stmt.append(op1)
+                    operands.append(op1.strip())
                 if op1 is not None and op2 is not None:
-                    stmt.append(op2.strip("'"))
-                self.il_program.append(stmt)
+                    operands.append(op2.strip("'"))
+                statements.append((ln_num, instr, operands))
                 if label is not None:
                     label = label.strip(':')
                     if label in self.il_labels:
                         raise Exception
-                    self.il_labels[label] = len(self.il_program) - 1
-            pass
+                    self.il_labels[label] = len(statements) - 1
+
+        self.link_interpreter(ILImage(
+            self.il_labels, [self.assemble(*stmt) for stmt in statements]))
+
+
+    def link_interpreter(self, image):
+        """Bind the IL program in ILImage `image` to this interpreter's
+        handlers.
+
+        The image is shared, but the dispatch loop calls bound methods, so
+        `il_ops`, `il_base_program` and `il_program` belong to each
+        interpreter. They are built from a link plan shared by interpreters
+        with the same options; see `plan_program()`.
+        """
+        for label in ('ERRENT', 'CO', 'XEC'):
+            if label not in image.labels:
+                raise ValueError(f'IL program has no {label} label.')
+        self.il_image = image
+        self.il_labels = image.labels
+        self.il_instructions = image.instructions
+        self.errent_pc = self.il_labels['ERRENT']
+        self.co_pc = self.il_labels['CO']
+        self.xec_pc = self.il_labels['XEC']
+
+        il_ops = self.il_ops
+        self.il_base_program = [(il_ops[op], args)
+                                for op, args in self.il_instructions]
+        self.line_pc = len(self.il_base_program)
+        self.il_base_program.append((self.il_line, ()))
+        self.run_pc = len(self.il_base_program)
+        self.il_base_program.append((self.il_run, ()))
+        self.expression_pcs = {self.il_labels[label]
+                               for label in self.expression_labels
+                               if label in self.il_labels}
+
+        key = (image.fingerprint, self.native_expressions,
+               self.superinstructions, self.expression_labels,
+               tuple(self.il_superinstructions.items()))
+        plan = il_link_plans.get(key)
+        if plan is None:
+            plan = il_link_plans[key] = self.plan_program()
+        base = self.il_base_program
+        self.il_program = [base[pc] if step is None else self.bind(pc, step)
+                           for pc, step in enumerate(plan)]
+
+
+    def plan_program(self):
+        """Work out how `link_interpreter()` links the IL in `il_image`,
+        with this interpreter's options.
+
+        The plan has a step for each entry of `il_program`: None for the
+        instruction's own handler, or a (kind, name, operands) tuple for
+        `bind()`, which is one of
+
+        - ('method', name, operands): the handler method `name`;
+        - ('done', name, operands): the same, with the DONE handler added
+          to the operands;
+        - ('into', dest, step): `il_icall_into()` into the subroutine at
+          `dest`, which starts with `step`;
+        - ('dispatch', (table, steps), fallback): `il_tst_dispatch()`,
+          with `table` mapping characters to instruction indices, and
+          `steps` mapping those and `fallback` to their steps.
+
+        The plan only depends on the IL and the options, so it is kept in
+        `il_link_plans` for other interpreters.
+        """
+        plan = [None] * len(self.il_base_program)
+        if self.native_expressions:
+            for pc, (op, args) in enumerate(self.il_instructions):
+                if op == 'ICALL' and args[0] in self.expression_pcs:
+                    plan[pc] = ('method', 'il_expr', args)
+        if self.superinstructions:
+            self.fuse_instructions(plan)
+            self.index_keywords(plan)
+        return tuple(plan)
+
+
+    def bind(self, pc, step):
+        """The (handler, operands) pair for instruction `pc` from a step of
+        `plan_program()`."""
+        if step is None:
+            return self.il_base_program[pc]
+        kind, name, args = step
+        if kind == 'into':
+            return self.il_icall_into, (name, *self.bind(name, args))
+        if kind == 'dispatch':
+            table, steps = name
+            entries = {dest: (dest, *self.bind(dest, step))
+                       for dest, step in steps.items()}
+            return self.il_tst_dispatch, ({char: entries[dest]
+                                           for char, dest in table.items()},
+                                          entries[args])
+        if kind == 'done':
+            args = (*args, self.il_ops['DONE'])
+        return getattr(self, name), args
+
+
+    def fuse_instructions(self, plan):
+        """Peephole pass over `plan`, a plan for `il_program`.
+
+        The first instruction of each run in `il_superinstructions` is
+        replaced with the superinstruction for the run, and an ICALL with
+        one that also carries out the first instruction of its subroutine.
+        The rest of each run stays in place for jumps into its middle, and
+        `il_base_program` keeps the unfused instructions for the profiler.
+        Instructions that already have a native handler are left alone.
+        A failed test also carries out the instruction it fails to; see
+        `fail_test()`.
+        """
+        ops = self.il_image.opcodes
+        instructions = self.il_instructions
+        for pc in range(len(instructions)):
+            for run, name in self.il_superinstructions.items():
+                if (ops[pc:pc + len(run)] == run
+                        and all(plan[i] is None
+                                for i in range(pc, pc + len(run)))):
+                    args = tuple(arg for _, args
+                                 in instructions[pc:pc + len(run)]
+                                 for arg in args)
+                    plan[pc] = ('done' if run[0] == 'DONE' else 'method',
+                                name, args)
+                    break
+
+        def called(pc, seen=()):
+            if ops[pc] == 'ICALL' and pc not in seen and plan[pc] is None:
+                dest = instructions[pc][1][0]
+                return ('into', dest, called(dest, (*seen, pc)))
+            return plan[pc]
+
+        plan[:len(instructions)] = [called(pc)
+                                    for pc in range(len(instructions))]
+
+
+    def index_keywords(self, plan, min_tests=4):
+        """Replace the first TST of each chain of at least `min_tests`
+        keyword tests in `plan`, such as the statement executor's, with a
+        lookup.
+
+        In a chain, each TST fails to the next one. Only tests whose
+        keyword starts with the next character of the line can match, so
+        the lookup goes straight to the first of those, skipping tests that
+        would fail. Failing that, it goes to the last test in the chain, to
+        fail the way the chain did. See `il_tst_dispatch()`.
+        """
+        ops = self.il_instructions
+        fail_targets = {args[0] for op, args in ops if op == 'TST'}
+        chains = []
+        for head, (op, _) in enumerate(ops):
+            if op != 'TST' or head in fail_targets:
+                continue
+            chain = [head]
+            while True:
+                dest = ops[chain[-1]][1][0]
+                if ops[dest][0] != 'TST' or dest in chain:
+                    break
+                chain.append(dest)
+            if len(chain) >= min_tests:
+                chains.append(chain)
+
+        dispatch = []
+        for chain in chains:
+            table = {}
+            for pc in chain:
+                first = ops[pc][1][1][0]
+                table.setdefault(first, pc)
+                table.setdefault(first.lower(), pc)
+            table = types.MappingProxyType(table)
+            steps = types.MappingProxyType({pc: plan[pc] for pc in chain})
+            dispatch.append((chain[0],
+                             ('dispatch', (table, steps), chain[-1])))
+        for pc, step in dispatch:
+            plan[pc] = step
+
+
+    def assemble(self, ln_num, instr, operands):
+        """Verify one IL statement and convert its operands."""
+        if instr not in self.il_ops:
+            raise ValueError(f'IL line {ln_num}: unknown instruction {instr}.')
+        kinds = self.il_operands.get(instr, ())
+        if len(operands) != len(kinds):
+            raise ValueError(f'IL line {ln_num}: {instr} takes '
+                             f'{len(kinds)} operand(s), got {len(operands)}.')
+        args = []
+        for kind, operand in zip(kinds, operands):
+            if kind == 'label':
+                if operand not in self.il_labels:
+                    raise ValueError(
+                        f'IL line {ln_num}: unknown label {operand}.')
+                args.append(self.il_labels[operand])
+            elif kind == 'int':
+                args.append(int(operand))
+            elif operand.isdigit():             # 'str': ASCII code or text
+                args.append(bytes([int(operand)]).decode(encoding='ascii'))
+            else:
+                args.append(operand)
+        return instr, tuple(args)
 
     #
     # Syntax parsing instructions
     #
 
     def il_done(self):
-        self.line_buffer = self.line_buffer.strip()
-        if self.line_buffer != '':
-            print(f'Syntax error at line {self.basic_linenum - 1}.')
-            self.pc = self.il_labels['ERRENT']
+        self.line_buffer.strip()
+        if not self.line_buffer.at_end():
+            self.syntax_error()
 
 
     def il_done_tbx(self):
         """Used only in TBX."""
-        self.line_buffer = self.line_buffer.strip()
-        if self.line_buffer.startswith('$'):        
-            self.line_buffer = self.line_buffer[1:] 
-            self.pc = self.il_labels['XEC']     
-        elif self.line_buffer != '':
-            print(f'Syntax error at line {self.basic_linenum - 1}.')
-            self.pc = self.il_labels['ERRENT']
+        self.line_buffer.strip()
+        if self.line_buffer.startswith('$'):
+            self.line_buffer.pos += 1
+            self.pc = self.xec_pc
+        elif not self.line_buffer.at_end():
+            self.syntax_error()
 
 
     def il_donex(self):
@@ -150,94 +992,153 @@ class TinyBasicInterpreter:
 
 
     def il_tst(self, dest_label, test_str):
-        self.line_buffer = self.line_buffer.strip()
-        if test_str.isdigit():
-            ch = int(test_str)
-            test_str = bytes([ch]).decode(encoding='ascii')
-        if test_str == '\r' and self.line_buffer == '':
-            pass
-        elif self.line_buffer.upper().startswith(test_str):
-            self.line_buffer = self.line_buffer[len(test_str):]
-        else:
+        if not self.line_buffer.match(test_str):
             self.fail_test(dest_label)
 
 
     def il_tsta(self, dest_label):
         """Used only in TBX."""
-        self.line_buffer = self.line_buffer.strip()
-        v = self.line_buffer[:1]
-        if v.isalpha() and len(self.line_buffer) >= 2 and self.line_buffer[1] == '(':
-            self.expression_stack.insert(0, ord(v.upper()) - ord('A'))
-            self.line_buffer = self.line_buffer[1:]
+        v = self.line_buffer.variable(array=True)
+        if v is not None:
+            self.expression_stack.push(v)
         else:
             self.fail_test(dest_label)
 
 
     def il_tstf(self, dest_label):
         """Used only in TBX."""
-        self.line_buffer = self.line_buffer.strip()
-        if len(self.line_buffer) < 2 or not self.line_buffer[0:2].isalpha():
+        if not self.line_buffer.function():
             self.fail_test(dest_label)
 
 
     def il_tstl(self, dest_label):
-        head, _, _ = self.line_buffer.strip().partition(' ')
+        head, _, _ = str(self.line_buffer).strip().partition(' ')
         try:
             line_num = int(head)
             if 1 <= line_num < self.max_lines:
                 pass
             else:
-                print('Invalid line number.')
-                self.pc = self.il_labels['ERRENT']
+                self.basic_error('Invalid line number.', code=7)
         except ValueError:
             self.fail_test(dest_label)
 
 
     def il_tstn(self, dest_label):
-        self.line_buffer = self.line_buffer.strip()
-        n = ''
-        while self.line_buffer[:1].isdigit():
-            n += self.line_buffer[:1]
-            self.line_buffer = self.line_buffer[1:]
+        n = self.line_buffer.digits()
         if len(n) > 0:
-            self.expression_stack.insert(0, int(n))
+            self.expression_stack.push(int(n))
         else:
             self.fail_test(dest_label)
 
 
     def il_tstv(self, dest_label):
-        self.line_buffer = self.line_buffer.strip()
-        v = self.line_buffer[:1]
-        if v.isalpha():
-            self.expression_stack.insert(0, ord(v.upper()) - ord('A'))
-            self.line_buffer = self.line_buffer[1:]
+        v = self.line_buffer.variable()
+        if v is not None:
+            self.expression_stack.push(v)
         else:
             self.fail_test(dest_label)
 
+    #
+    # Superinstructions
+    #
+
+    def il_tstv_ind_rtn(self, dest_label):
+        """TSTV, IND, RTN."""
+        v = self.line_buffer.variable()
+        if v is not None:
+            self.expression_stack.push(self.basic_var_data[v])
+            self.pc = self.control_stack.pop()
+        else:
+            self.fail_test(dest_label)
+
+
+    def il_tstn_rtn(self, dest_label):
+        """TSTN, RTN."""
+        n = self.line_buffer.digits()
+        if len(n) > 0:
+            self.expression_stack.push(int(n))
+            self.pc = self.control_stack.pop()
+        else:
+            self.fail_test(dest_label)
+
+
+    def il_tstv_tst(self, var_label, dest_label, test_str):
+        """TSTV, TST."""
+        v = self.line_buffer.variable()
+        if v is None:
+            self.fail_test(var_label)
+            return
+        self.expression_stack.push(v)
+        self.pc += 1
+        if not self.line_buffer.match(test_str):
+            self.fail_test(dest_label)
+
+
+    def il_tst_icall(self, dest_label, test_str, call_label):
+        """TST, ICALL."""
+        if self.line_buffer.match(test_str):
+            self.control_stack.push(self.pc + 1)
+            self.pc = call_label
+        else:
+            self.fail_test(dest_label)
+
+
+    def il_tst_dispatch(self, table, fallback):
+        """A chain of TSTs, starting with the first that can match the next
+        character of the line; see `index_keywords()`."""
+        buf = self.line_buffer
+        buf.strip()
+        if buf.pos < buf.end:
+            char = buf.text[buf.pos]
+            entry = table.get(char)
+            if entry is None and not char.isascii():
+                entry = table.get(char.upper()[:1])
+        else:
+            entry = table.get('\r')
+        pc, handler, args = entry or fallback
+        self.pc = pc + 1
+        handler(*args)
+
+
+    def il_done_nxt(self, done):
+        """DONE, NXT, where `done` is the handler for DONE."""
+        pc = self.pc
+        done()
+        if self.pc == pc:
+            self.pc = pc + 1
+            self.il_nxt()
+
     #
     # IL flow control instructions
     #
 
     def il_icall(self, dest_label):
-        self.control_stack.insert(0, self.pc)
-        self.pc = self.il_labels[dest_label]
+        self.control_stack.push(self.pc)
+        self.pc = dest_label
+
+
+    def il_icall_into(self, dest_label, handler, args):
+        """ICALL, followed by the first instruction of the subroutine."""
+        self.control_stack.push(self.pc)
+        self.pc = dest_label + 1
+        handler(*args)
 
 
     def il_ijmp(self, dest_label):
-        self.pc = self.il_labels[dest_label]
+        self.pc = dest_label
 
 
     def il_rtn(self):
-        self.pc = self.control_stack.pop(0)
+        self.pc = self.control_stack.pop()
 
     #
     # BASIC flow control instructions
     #
 
     def il_cmpr(self):
-        operand2 = self.expression_stack.pop(0)
-        operator = self.expression_stack.pop(0)
-        operand1 = self.expression_stack.pop(0)
+        operand2 = self.expression_stack.pop()
+        operator = self.expression_stack.pop()
+        operand1 = self.expression_stack.pop()
         if operator == 0:
             cmpr = operand1 == operand2
         elif operator == 1:
@@ -257,138 +1158,205 @@ class TinyBasicInterpreter:
     
 
     def il_for(self):
-        """Used only in TBX."""
-        next_line = self.basic_linenum
-        while self.basic_program[next_line].strip() == '':
-            next_line += 1
-        self.expression_stack.insert(0, next_line)
+        """Used only in TBX.
+
+        Start a loop over the variable on the expression stack, up to the
+        limit above it, whose body starts at the next stored line. A loop
+        already running over the variable, say one left by a GOTO, ends
+        along with the loops inside it.
+        """
+        limit = self.expression_stack.pop()
+        var = self.expression_stack.pop()
+        i = bisect.bisect_left(self.basic_lines, self.basic_linenum)
+        if i < len(self.basic_lines):
+            next_line = self.basic_lines[i]
+        else:
+            next_line = self.max_lines
+        for depth in range(len(self.loop_stack)):
+            if self.loop_stack[depth][0] == var:
+                for _ in range(depth + 1):
+                    self.loop_stack.pop()
+                break
+        self.loop_stack.push((var, limit, next_line))
     
 
     def il_fornext(self):
-        """Used only in TBX."""
-        var = self.expression_stack.pop(0)
-        end_cond = self.expression_stack.pop(0)
-        for_body = self.expression_stack.pop(0)
-        if self.basic_var_data[var] < end_cond:
-            self.basic_linenum = for_body
-            self.expression_stack.insert(0, for_body)
-            self.expression_stack.insert(0, end_cond)
-        self.expression_stack.insert(0, var)
-        self.expression_stack.insert(0, self.basic_var_data[var] + 1)
+        """Used only in TBX.
+
+        Step the variable on the expression stack, and go back to the body
+        of the innermost loop unless the variable had reached its limit.
+        """
+        var = self.expression_stack.pop()
+        if not self.loop_stack:
+            self.basic_error('NXT without FOR.')
+            return
+        value = self.basic_var_data[var]
+        _, limit, body = self.loop_stack[0]
+        if value < limit:
+            self.basic_linenum = body
+        else:
+            self.loop_stack.pop()
+        self.basic_var_data[var] = value + 1
 
 
     def il_fin(self):
+        self.exit_status = 'end'
         self.basic_linenum = 0
-        self.pc = self.il_labels['CO']
+        self.pc = self.co_pc
 
 
     def il_insrt(self):
-        self.line_buffer = self.line_buffer.strip()
-        line_num = ''
-        while self.line_buffer[:1].isdigit():
-            line_num += self.line_buffer[:1]
-            self.line_buffer = self.line_buffer[1:]
-        self.basic_program[int(line_num)] = self.line_buffer.strip()
-        self.line_buffer = ''
+        line_num = int(self.line_buffer.digits())
+        line = str(self.line_buffer).strip()
+        i = bisect.bisect_left(self.basic_lines, line_num)
+        exists = i < len(self.basic_lines) and self.basic_lines[i] == line_num
+        if line != '':
+            self.basic_program[line_num] = line
+            if not exists:
+                self.basic_lines.insert(i, line_num)
+        elif exists:
+            del self.basic_program[line_num]
+            del self.basic_lines[i]
+        self.line_cache.pop(line_num, None)
+        self.compiled_lines = None
+        self.line_buffer.reset('')
 
 
     def il_nxt(self):
         if self.basic_linenum == 0:
-            self.pc = self.il_labels['CO']
+            self.pc = self.co_pc
+        elif self.compiled_lines is not None:
+            self.pc = self.run_pc
         else:
-            while (self.basic_linenum < self.max_lines
-                   and self.basic_program[self.basic_linenum].strip() == ''):
-                self.basic_linenum += 1
-            if self.basic_linenum == self.max_lines:
+            i = bisect.bisect_left(self.basic_lines, self.basic_linenum)
+            if i == len(self.basic_lines):
                 self.basic_linenum = 0
-                self.pc = self.il_labels['CO']
+                self.pc = self.co_pc
             else:
-                self.line_buffer = self.basic_program[self.basic_linenum]
-                self.basic_linenum += 1
-                self.pc = self.il_labels['XEC']
+                self.load_line(self.basic_lines[i])
+
+
+    def load_line(self, line_num):
+        """Start executing stored line `line_num`."""
+        text = self.basic_program[line_num]
+        self.line_buffer.reset(text)
+        self.basic_linenum = line_num + 1
+        if self.profiler is not None or self.hooks is not None:
+            if self.profiler is not None:
+                self.profiler.line_counts[line_num] += 1
+            self.fire('line', line_num)
+            self.pc = self.xec_pc
+        else:
+            actions = self.line_cache.get(line_num)
+            if actions is None and self.cache_lines:
+                actions = self.compile_line(text) or ()
+                self.line_cache[line_num] = actions
+            if actions:
+                self.line_actions = actions
+                self.pc = self.line_pc
+            else:
+                self.pc = self.xec_pc
+        if self.breakpoints and line_num in self.breakpoints:
+            raise BreakpointHit
 
 
     def il_nxtx(self):
         """Used only in TBX."""
-        self.pc = self.il_labels['XEC']
+        self.pc = self.xec_pc
 
 
     def il_xfer(self):
-        loc = self.expression_stack.pop(0)
+        loc = self.expression_stack.pop()
 
         if 1 <= loc < self.max_lines:
-            if self.basic_program[loc] != '':
+            if loc in self.basic_program:
                 self.basic_linenum = loc
                 self.il_nxt()
             else:
-                print('Invalid line number.')
-                self.pc = self.il_labels['ERRENT']
+                self.basic_error('Invalid line number.', code=7)
         else:
-            print('Invalid line number.')
-            self.pc = self.il_labels['ERRENT']
+            self.basic_error('Invalid line number.', code=7)
 
     #
     # BASIC variable & stack instructions
     #
 
     def il_ind(self):
-        i = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, self.basic_var_data[i])
+        i = self.expression_stack.pop()
+        if i < 26:
+            self.expression_stack.append(self.basic_var_data[i])
+        else:
+            self.expression_stack.append(self.basic_array_data[i])
 
 
     def il_lit(self, val):
-        self.expression_stack.insert(0, int(val))
+        self.expression_stack.push(val)
 
 
     def il_rstr(self):
-        self.basic_linenum = self.subroutine_stack.pop(0)
+        if not self.subroutine_stack:
+            self.il_err(10)
+            return
+        self.basic_linenum = self.subroutine_stack.pop()
 
 
     def il_sav(self):
-        self.subroutine_stack.insert(0, self.basic_linenum)
+        self.subroutine_stack.push(self.basic_linenum)
 
 
     def il_store(self):
-        value = self.expression_stack.pop(0)
-        var_index = self.expression_stack.pop(0)
-        self.basic_var_data[var_index] = value
+        value = self.expression_stack.pop()
+        var_index = self.expression_stack.pop()
+        if var_index < 26:
+            self.basic_var_data[var_index] = value
+        else:
+            self.basic_array_data[var_index] = value
+
+
+    def il_storev(self):
+        """Used only in TBX.
+
+        Like STORE, but leave the variable on the expression stack, for FOR.
+        """
+        value = self.expression_stack.pop()
+        self.basic_var_data[self.expression_stack[0]] = value
 
     #
     # Arithmetic instructions
     #
 
     def il_add(self):
-        operand2 = self.expression_stack.pop(0)
-        operand1 = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, operand1 + operand2)
+        operand2 = self.expression_stack.pop()
+        operand1 = self.expression_stack.pop()
+        self.expression_stack.append(operand1 + operand2)
 
 
     def il_div(self):
-        operand2 = self.expression_stack.pop(0)
-        operand1 = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, operand1 // operand2)
+        operand2 = self.expression_stack.pop()
+        operand1 = self.expression_stack.pop()
+        self.expression_stack.append(operand1 // operand2)
 
 
     def il_mpy(self):
-        operand2 = self.expression_stack.pop(0)
-        operand1 = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, operand1 * operand2)
+        operand2 = self.expression_stack.pop()
+        operand1 = self.expression_stack.pop()
+        self.expression_stack.append(operand1 * operand2)
 
 
     def il_neg(self):
-        operand = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, 0 - operand)
+        operand = self.expression_stack.pop()
+        self.expression_stack.append(0 - operand)
     
 
     def il_random(self):
         """Used only in TBX."""
-        self.expression_stack.insert(0, random.randint(0, 10000))
+        self.expression_stack.push(self.random.randint(0, 10000))
 
 
     def il_sub(self):
-        operand2 = self.expression_stack.pop(0)
-        operand1 = self.expression_stack.pop(0)
-        self.expression_stack.insert(0, operand1 - operand2)
+        operand2 = self.expression_stack.pop()
+        operand1 = self.expression_stack.pop()
+        self.expression_stack.append(operand1 - operand2)
     
     #
     # TBX array instructions
@@ -396,99 +1364,195 @@ class TinyBasicInterpreter:
 
     def il_array1(self):
         """Used only in TBX."""
-        offset = self.expression_stack.pop(0)
-        idx = self.basic_var_data[self.expression_stack.pop(0)]
-        self.expression_stack.insert(0, idx + offset)
+        offset = self.expression_stack.pop()
+        v = self.expression_stack.pop()
+        idx = self.basic_var_data[v] + offset
+        if idx not in self.basic_array_cells[v]:
+            self.il_err(11)
+        self.expression_stack.append(idx)
 
 
     def il_array2(self):
         """Used only in TBX."""
-        y = self.expression_stack.pop(0)
-        x = self.expression_stack.pop(0)
-        v = self.expression_stack.pop(0)
+        y = self.expression_stack.pop()
+        x = self.expression_stack.pop()
+        v = self.expression_stack.pop()
         base_idx = self.basic_var_data[v]
         width = self.basic_array_widths[v]
         idx = base_idx + (y * width) + x
-        self.expression_stack.insert(0, idx)
+        if not 0 <= x < width or idx not in self.basic_array_cells[v]:
+            self.il_err(11)
+        self.expression_stack.append(idx)
 
 
     def il_dim1(self):
         """Used only in TBX."""
-        size = self.expression_stack.pop(0) + 1
-        var = self.expression_stack.pop(0)
-        idx = len(self.basic_var_data)
-        self.basic_var_data[var] = idx
-        self.basic_var_data += [0 for _ in range(size)]
+        size = self.expression_stack.pop() + 1
+        var = self.expression_stack.pop()
+        self.allocate_array(var, (max(size, 0),))
 
 
     def il_dim2(self):
         """Used only in TBX."""
-        y_size = self.expression_stack.pop(0) + 1
-        x_size = self.expression_stack.pop(0) + 1
-        var = self.expression_stack.pop(0)
-        idx = len(self.basic_var_data)
+        y_size = self.expression_stack.pop() + 1
+        x_size = self.expression_stack.pop() + 1
+        var = self.expression_stack.pop()
+        self.allocate_array(var, (max(x_size, 0), max(y_size, 0)))
+
+
+    def allocate_array(self, var, dims):
+        """Give variable `var` a new, zeroed array with dimensions `dims`.
+
+        The new array replaces any array the variable had before, whose
+        cells are freed first. Cells are taken from the first free run
+        that is large enough, or else added to the end of
+        `basic_array_data`. Going over `max_array_cells` is TBX error 14,
+        and leaves the old array as it was.
+        """
+        size = math.prod(dims)
+        in_use = self.array_cells_used - len(self.basic_array_cells[var])
+        if in_use + size > self.max_array_cells:
+            self.il_err(14)
+            return
+        self.free_array(var)
+        data = self.basic_array_data
+        for i, cells in enumerate(self.free_cells):
+            if len(cells) >= size:
+                idx = cells.start
+                if len(cells) > size:
+                    self.free_cells[i] = range(idx + size, cells.stop)
+                else:
+                    del self.free_cells[i]
+                data[idx:idx + size] = array.array('q', bytes(8 * size))
+                break
+        else:
+            idx = len(data)
+            data.frombytes(bytes(8 * size))
+        self.array_cells_used += size
         self.basic_var_data[var] = idx
-        self.basic_var_data += [0 for _ in range(y_size * x_size)]
-        self.basic_array_widths[var] = x_size
+        self.basic_array_widths[var] = dims[0] if len(dims) == 2 else 0
+        self.basic_arrays[var] = (idx, dims)
+        self.basic_array_cells[var] = range(idx, idx + size)
+
+
+    def free_array(self, var):
+        """Return the cells of `var`'s array, if it has one, to the free
+        runs, merging neighbouring runs and trimming free cells at the end
+        of `basic_array_data`."""
+        cells = self.basic_array_cells[var]
+        self.basic_arrays.pop(var, None)
+        self.basic_array_cells[var] = range(0)
+        self.basic_array_widths[var] = 0
+        if not cells:
+            return
+        self.array_cells_used -= len(cells)
+        free = self.free_cells
+        i = bisect.bisect_left([run.start for run in free], cells.start)
+        if i < len(free) and free[i].start == cells.stop:
+            cells = range(cells.start, free.pop(i).stop)
+        if i > 0 and free[i - 1].stop == cells.start:
+            i -= 1
+            cells = range(free.pop(i).start, cells.stop)
+        if cells.stop == len(self.basic_array_data):
+            del self.basic_array_data[cells.start:]
+        else:
+            free.insert(i, cells)
 
     #
     # Terminal I/O instructions
     #
 
+    def read_line(self, prompt):
+        """Flush output and read a line of input after `prompt`."""
+        if self.inputs is not None:
+            if not self.headless and not self.awaiting_input:
+                self.output.write(prompt)
+            self.output.flush()
+            try:
+                line = str(next(self.inputs))
+            except InputNeeded:
+                self.awaiting_input = True
+                raise
+            except StopIteration:
+                raise EOFError from None
+            self.awaiting_input = False
+            return line
+        if self.output.sink is None:
+            self.output.flush()
+            return input(prompt)
+        self.output.write(prompt)
+        self.output.flush()
+        return input()
+
+
     def il_getln(self):
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.finish()
         if len(self.line_buffer_buffer) > 0:
-            self.line_buffer = self.line_buffer_buffer.pop(0)
-            print(f'{self.command_prompt}{self.line_buffer}', end='')
+            line = self.line_buffer_buffer.pop(0)
+            if not self.headless:
+                self.output.write(f'{self.command_prompt}{line}')
+        elif self.headless:
+            line = ''
+            self.user_quit = True
         else:
-            self.line_buffer = ''
+            line = ''
             try:
-                while len(self.line_buffer) < 1:
-                    self.line_buffer = input(self.command_prompt)
+                while len(line) < 1:
+                    line = self.read_line(self.command_prompt)
             except EOFError:
                 self.user_quit = True
+            except InputNeeded:
+                self.pc -= 1
+                raise
+        self.line_buffer.reset(line)
 
 
     def il_innum(self):
         while len(self.innum_buffer) == 0:
             try:
-                user_input = input(self.input_prompt)
+                user_input = self.read_line(self.input_prompt)
                 self.innum_buffer = [int(n) for n in user_input.split(',')]
             except ValueError:
-                print('Type a number.')
+                if self.headless:
+                    self.basic_error('Type a number.', BasicInputError)
+                self.output.write('Type a number.\n')
             except EOFError:
+                if self.headless:
+                    self.basic_error('Out of input.', BasicInputError)
                 self.user_quit = True
                 return
-        self.expression_stack.insert(0, self.innum_buffer.pop(0))
+            except InputNeeded:
+                self.pc -= 1
+                raise
+        self.expression_stack.push(self.innum_buffer.pop(0))
 
 
     def il_nline(self):
-        print()
+        self.output.write('\n')
 
 
     def il_prn(self):
-        n = self.expression_stack.pop(0)
-        print(n, end='')
+        n = self.expression_stack.pop()
+        self.output.write(str(n))
 
 
     def il_prs(self):
-        pr_str, _, tail = self.line_buffer.partition('"')
-        print(pr_str, end='')
-        self.line_buffer = tail
+        self.output.write(self.line_buffer.partition('"'))
 
 
     def il_spc(self):
-        print('\t', end='')
+        self.output.write('\t')
 
 
     def il_spcone(self):
         """Used only in TBX."""
-        print(' ', end='')
+        self.output.write(' ')
 
 
     def il_tab(self):
         """Used only in TBX."""
-        for _ in range(self.expression_stack.pop(0)):
-            print(' ', end='')
+        self.output.write(' ' * self.expression_stack.pop())
         self.control_stack[2] += 1  # Skip printing the "result"
     
     #
@@ -497,125 +1561,1876 @@ class TinyBasicInterpreter:
 
     def il_list0(self):
         """Used only in TBX."""
-        self.listing_range = [n for n in range(self.max_lines)]
+        self.listing_range = range(self.max_lines)
     
 
     def il_list1(self):
         """Used only in TBX."""
-        n = self.expression_stack.pop(0)
+        n = self.expression_stack.pop()
         if 1 <= n < self.max_lines:
-            self.listing_range = [n]
+            self.listing_range = range(n, n + 1)
         else:
-            self.il_err('7')
+            self.il_err(7)
     
 
     def il_list2(self):
         """Used only in TBX."""
-        m = self.expression_stack.pop(0)
-        n = self.expression_stack.pop(0)
+        m = self.expression_stack.pop()
+        n = self.expression_stack.pop()
         if (1 <= n < self.max_lines) and (1 <= m < self.max_lines):
-            self.listing_range = [i for i in range(n, m + 1)]
+            self.listing_range = range(n, m + 1)
         else:
-            self.il_err('7')
+            self.il_err(7)
 
 
     def il_lst(self):
-        for linenum in self.listing_range:
-            line = self.basic_program[linenum].strip()
-            if line != '':
-                print(f'{linenum:>3} {line}')
+        lo = bisect.bisect_left(self.basic_lines, self.listing_range.start)
+        hi = bisect.bisect_left(self.basic_lines, self.listing_range.stop)
+        for linenum in self.basic_lines[lo:hi]:
+            self.output.write(f'{linenum:>3} {self.basic_program[linenum]}\n')
     
 
     def il_size(self):
         """Used only in TBX."""
-        lines = [0 for line in self.basic_program if line.strip() != '']
-        print(f'The program currently has {len(lines)} lines.')
-        print('I know that\'s not what you asked, but there it is!')
+        self.output.write(
+            f'The program currently has {len(self.basic_lines)} lines.\n')
+        self.output.write(
+            'I know that\'s not what you asked, but there it is!\n')
 
     #
     # Misc instructions
     #
 
-    def il_err(self, code):
+    def il_profile(self):
         """Used only in TBX."""
-        if code == '1':
-            print('Line too long.')
-        elif code == '2':
-            print('Numeric overflow.')
-        elif code == '3':
-            print('Illegal character.')
-        elif code == '4':
-            print('Unclosed quote.')
-        elif code == '5':
-            print('Expression too complex.')
-        elif code == '6':
-            print('Illegal expression.')
-        elif code == '7':
-            print('Invalid line number.')
-        elif code == '8':
-            print('Division by zero.')
-        elif code == '9':
-            print('Subroutines nested too deep.')
-        elif code == '10':
-            print('RET without GOSUB.')
-        elif code == '11':
-            print('Illegal variable.')
-        elif code == '12':
-            print('Bad command or statement name.')
-        elif code == '13':
-            print('Unmatched parentheses.')
-        elif code == '14':
-            print('OOM')
+        if self.profiler is None:
+            self.profile(on_finish=self.print_profile)
         else:
+            self.profiler = None
+        raise LoopChanged
+
+
+    def print_profile(self, profiler):
+        self.output.write(profiler.report())
+
+
+    def profile(self, sample=1, on_finish=None):
+        """Profile each following RUN with a new `Profiler`, and return it.
+
+        Profiling runs every line through the IL, so that all of its time
+        is spent in IL instructions, rather than pre-parsed or compiled
+        lines.
+        """
+        labels = []
+        names = {pc: label for label, pc in self.il_labels.items()}
+        for pc in range(len(self.il_program)):
+            labels.append(names.get(pc, labels[-1] if labels else ''))
+        opcodes = [op for op, _ in self.il_instructions] + ['LINE', 'RUN']
+        self.profiler = Profiler(opcodes, labels, sample, on_finish)
+        self.compiled_lines = None
+        return self.profiler
+
+
+    def il_err(self, code):
+        """Used only in TBX."""
+        if code not in self.error_messages:
             raise Exception
-        self.pc = self.il_labels['ERRENT']
+        self.basic_error(self.error_messages[code], code=code)
 
     def il_init(self):
-        self.line_buffer = ''
+        self.line_buffer.reset('')
         self.innum_buffer = []
-        self.basic_program = ['' for _ in range(self.max_lines)]
+        self.basic_program = {}
+        self.basic_lines = []
         self.basic_var_data = [0 for _ in range(26)]
+        self.basic_array_data = array.array('q', bytes(8 * 26))
+        self.basic_array_widths = [0 for _ in range(26)]
+        self.basic_arrays = {}
+        self.basic_array_cells = [range(0) for _ in range(26)]
+        self.free_cells = []
+        self.array_cells_used = 0
+        self.line_cache.clear()
+        self.expression_cache.clear()
+        self.compiled_lines = None
 
-        self.expression_stack = []
-        self.control_stack = []
-        self.subroutine_stack = []
+        self.expression_stack.clear()
+        self.control_stack.clear()
+        self.subroutine_stack.clear()
+        self.loop_stack.clear()
 
 
     def il_xinit(self):
         self.innum_buffer = []
 
         # If line buffer is empty, 'RUN' command was issued
-        if len(self.line_buffer.strip()) < 1:
-            self.expression_stack = []
-            self.control_stack = []
-            self.subroutine_stack = []
+        if self.line_buffer.is_blank():
+            self.expression_stack.clear()
+            self.control_stack.clear()
+            self.subroutine_stack.clear()
+            self.loop_stack.clear()
+            self.exit_status = None
+            if self.profiler is not None:
+                self.profiler.start()
+            elif (self.engine == 'compiled' and self.compiled_lines is None
+                  and self.hooks is None):
+                self.compile_program()
             self.basic_linenum = 1
             self.il_nxt()
 
+    #
+    # Hooks
+    #
+
+    def add_hook(self, event, hook):
+        """Call `hook` whenever `event`, one of `HOOK_EVENTS`, happens.
+
+        Hooks are called with the event's details:
+
+        - 'line': the number of a stored line about to run;
+        - 'op': the index in `il_base_program` and the opcode of an IL
+          instruction about to run;
+        - 'gosub': the line of a GOSUB, as its return address is saved;
+        - 'return': the line of a RETURN and the line of its GOSUB;
+        - 'store': the index of a variable in `basic_var_data`, or of a
+          TBX array cell in `basic_array_data`, and the value stored;
+        - 'error': the `BasicError` about to be raised or printed.
+
+        Lines are None in direct statements. While there are any hooks,
+        every line goes through the unfused IL, as when profiling, and
+        nothing is compiled; without them, `execute()` runs exactly as if
+        hooks did not exist. Hooks take effect the next time `execute()`
+        starts. Only 'line' and 'error' hooks are called while profiling.
+        """
+        if event not in HOOK_EVENTS:
+            raise ValueError(f'Unknown event {event!r}.')
+        if self.hooked_program is None:
+            self.link_hooks()
+        if self.hooks is None:
+            self.hooks = {}
+            self.compiled_lines = None
+        self.hooks.setdefault(event, []).append(hook)
+
+
+    def remove_hook(self, event, hook):
+        """Stop calling `hook` for `event`."""
+        hooks = self.hooks.get(event, []) if self.hooks is not None else []
+        if hook not in hooks:
+            raise ValueError(f'No such {event!r} hook.')
+        hooks.remove(hook)
+        if not hooks:
+            del self.hooks[event]
+            if not self.hooks:
+                self.hooks = None
+
+
+    def record_events(self, size=256, events=HOOK_EVENTS):
+        """Add hooks that keep the last `size` of `events` in a deque, and
+        return the deque.
+
+        Each entry is a tuple of the event name and its details, oldest
+        first, for a post-mortem of a run that went wrong.
+        """
+        log = collections.deque(maxlen=size)
+        for event in events:
+            self.add_hook(event,
+                          lambda *details, event=event:
+                          log.append((event,) + details))
+        return log
+
+
+    def fire(self, event, *details):
+        """Call the hooks for `event`."""
+        if self.hooks is not None:
+            for hook in self.hooks.get(event, ()):
+                hook(*details)
+
+
+    def link_hooks(self):
+        """Build `hooked_program` from `il_base_program`."""
+        wrappers = {'NEXT': self.hooked_fornext, 'RSTR': self.hooked_rstr,
+                    'SAV': self.hooked_sav, 'STORE': self.hooked_store,
+                    'STOREV': self.hooked_storev}
+        self.hooked_program = list(self.il_base_program)
+        for pc, (op, args) in enumerate(self.il_instructions):
+            if op in wrappers:
+                self.hooked_program[pc] = (wrappers[op], args)
+        self.hook_opcodes = self.il_image.opcodes
+
+
+    def current_line(self):
+        """The stored line running, or None in a direct statement."""
+        return self.basic_linenum - 1 if self.basic_linenum > 0 else None
+
+
+    def hooked_sav(self):
+        self.il_sav()
+        self.fire('gosub', self.current_line())
+
+
+    def hooked_rstr(self):
+        line = self.current_line()
+        self.il_rstr()
+        if self.pc != self.errent_pc:
+            self.fire('return', line, self.current_line())
+
+
+    def hooked_store(self):
+        value = self.expression_stack[0]
+        index = self.expression_stack[1]
+        self.il_store()
+        self.fire('store', index, value)
+
+
+    def hooked_storev(self):
+        value = self.expression_stack[0]
+        index = self.expression_stack[1]
+        self.il_storev()
+        self.fire('store', index, value)
+
+
+    def hooked_fornext(self):
+        index = self.expression_stack[0]
+        self.il_fornext()
+        if self.pc != self.errent_pc:
+            self.fire('store', index, self.basic_var_data[index])
+
+    #
+    # Line cache
+    #
+
+    def trace_line(self, text, expressions=False):
+        """Pre-parse a stored BASIC line into a tuple of IL operations.
+
+        The IL is followed from XEC over `text`, carrying out only the
+        syntax instructions. Every other instruction it reaches is recorded
+        as an (op, args) pair, in the order the IL would execute it:
+
+        - the values that TSTV, TSTA and TSTN would have pushed are
+          recorded as LIT operations;
+        - PRS carries the text it prints;
+        - TAB leaves IL return addresses alone, as the trace has none;
+        - XINIT is always the between-statements form, which only clears
+          pending INPUT values.
+
+        A CMPR is recorded as if it were true, since a false comparison
+        leaves the line anyway. The trace ends with the NXT, XFER or FIN
+        that leaves the line. With `expressions`, each expression that
+        `native_expression()` can evaluate is recorded as one EXPR
+        operation.
+
+        Returns None for lines that must always go through the IL, such as
+        lines with syntax errors or commands like LIST and RUN.
+        """
+        trace = self.trace_il(LineBuffer(text), self.xec_pc, expressions)
+        return None if trace is None else trace[0]
+
+
+    def trace_il(self, buf, pc, expressions=False, subroutine=False):
+        """Follow the IL from `pc` over `buf` as described in
+        `trace_line()`, and return the recorded operations along with the
+        deepest the trace nested ICALLs, or None.
+
+        With `subroutine`, the trace ends at the RTN from the subroutine
+        at `pc`, and leaves `buf` at the end of the text it parsed.
+        """
+        ops = self.il_instructions
+        calls = []
+        depth = 0
+        actions = []
+        for _ in range(10000):
+            op, args = ops[pc]
+            pc += 1
+            dest = args[0] if args else None
+            passed = True
+            if op == 'TST':
+                passed = buf.match(args[1])
+            elif op == 'TSTV' or op == 'TSTA':
+                v = buf.variable(array=(op == 'TSTA'))
+                if v is not None:
+                    actions.append(('LIT', (v,)))
+                else:
+                    passed = False
+            elif op == 'TSTF':
+                passed = buf.function()
+            elif op == 'TSTN':
+                n = buf.digits()
+                if len(n) > 0:
+                    try:
+                        actions.append(('LIT', (int(n),)))
+                    except ValueError:
+                        return None
+                else:
+                    passed = False
+            elif op == 'DONE' or op == 'DONEX':
+                buf.strip()
+                if (op == 'DONE' and self.enable_multistatement
+                        and buf.startswith('$')):
+                    buf.pos += 1
+                    pc = self.xec_pc
+                elif not buf.at_end():
+                    return None
+            elif op == 'PRS':
+                actions.append(('PRS', (buf.partition('"'),)))
+            elif op == 'ICALL':
+                if expressions and dest in self.expression_pcs:
+                    expression = self.native_expression(buf, dest)
+                    if (expression is not None and len(calls) + expression[2]
+                            <= self.control_stack.max_depth):
+                        # Replaying a literal or a variable is quicker
+                        trace = expression[4]
+                        if len(trace) > 2:
+                            actions.append(('EXPR', expression))
+                        else:
+                            actions.extend(trace)
+                        buf.pos = expression[1]
+                        continue
+                if len(calls) >= self.control_stack.max_depth:
+                    return None
+                depth = max(depth, len(calls))
+                calls.append(pc)
+                pc = dest
+            elif op == 'IJMP' or op == 'HOP':
+                pc = dest
+            elif op == 'RTN':
+                if len(calls) == 0:
+                    return (tuple(actions), depth) if subroutine else None
+                pc = calls.pop()
+            elif op == 'NXTX':
+                pc = self.xec_pc
+            elif op == 'XINIT':
+                if buf.is_blank():
+                    return None
+                actions.append(('XINIT', ()))
+            elif op == 'TAB':
+                if len(calls) < 3:
+                    return None
+                calls[-3] += 1
+                actions.append(('TAB', ()))
+            elif op == 'NXT' or op == 'XFER' or op == 'FIN':
+                actions.append((op, args))
+                return tuple(actions), depth
+            elif op in ('ADD', 'ARRAY1', 'ARRAY2', 'CMPR', 'DIM1', 'DIM2',
+                        'DIV', 'FOR', 'IND', 'INNUM', 'LIT', 'MPY', 'NEG',
+                        'NEXT', 'NLINE', 'PRN', 'RANDOM', 'RSTR', 'SAV',
+                        'SPC', 'SPCONE', 'STORE', 'STOREV', 'SUB'):
+                actions.append((op, args))
+            else:
+                return None
+            if not passed:
+                if pc - 1 == dest:
+                    return None
+                pc = dest
+        return None
+
+
+    def compile_line(self, text):
+        """Turn a line's trace into (handler, args, flow) actions for
+        `il_line()`, where `flow` marks handlers that may leave the line."""
+        trace = self.trace_line(text, self.native_expressions)
+        if trace is None:
+            return None
+        line_ops = {'LIT': self.il_lit, 'PRS': self.line_print,
+                    'TAB': self.line_tab, 'XINIT': self.line_xinit}
+        actions = []
+        for i, (op, args) in enumerate(trace):
+            if op == 'INNUM':
+                actions.append((self.line_innum, (i,), True))
+            elif op == 'EXPR':
+                evaluate, _, _, room, expression = args
+                subscripts = any(op in ('ARRAY1', 'ARRAY2')
+                                 for op, _ in expression)
+                actions.append((self.line_expr, (evaluate, room), subscripts))
+            else:
+                actions.append((line_ops.get(op) or self.il_ops[op], args,
+                                op in ('ARRAY1', 'ARRAY2', 'CMPR', 'DIM1',
+                                       'DIM2', 'NEXT', 'NXT', 'RSTR', 'XFER',
+                                       'FIN')))
+        return tuple(actions)
+
+
+    def il_line(self):
+        """Replay the pre-parsed actions of the current BASIC line."""
+        self.pc = -1
+        for handler, args, flow in self.line_actions:
+            handler(*args)
+            if flow and (self.pc != -1 or self.user_quit):
+                return
+
+
+    def line_innum(self, i):
+        """INNUM as action `i` of a line. To wait for input, the rest of
+        the line, from this action on, is left to replay later."""
+        try:
+            self.il_innum()
+        except InputNeeded:
+            actions = self.line_actions
+            for j, action in enumerate(actions):
+                if action[0] == self.line_innum and action[1] == (i,):
+                    self.line_actions = actions[j:]
+                    break
+            self.pc = self.line_pc
+            raise
+
+
+    def line_expr(self, evaluate, room):
+        """A native expression as an action of a line."""
+        if len(self.expression_stack) + room > self.expression_stack.max_depth:
+            raise StackOverflow(self.expression_stack.error_code)
+        try:
+            self.expression_stack.append(evaluate())
+        except BadSubscript:
+            self.il_err(11)
+
+
+    def line_print(self, pr_str):
+        self.output.write(pr_str)
+
+
+    def line_tab(self):
+        """TAB without the IL return address adjustment."""
+        self.output.write(' ' * self.expression_stack.pop())
+
+
+    def line_xinit(self):
+        """XINIT between statements of a line."""
+        self.innum_buffer = []
+
+    #
+    # Native expressions
+    #
+
+    def il_expr(self, dest_label):
+        """ICALL to an expression subroutine, carried out by a native
+        expression where there is one."""
+        buf = self.line_buffer
+        expression = self.native_expression(buf, dest_label)
+        if expression is not None:
+            evaluate, end, calls, room, _ = expression
+            if (len(self.control_stack) + calls <= self.control_stack.max_depth
+                    and len(self.expression_stack) + room
+                    <= self.expression_stack.max_depth):
+                try:
+                    value = evaluate()
+                except BadSubscript:
+                    self.il_err(11)
+                    return
+                self.expression_stack.append(value)
+                buf.pos = end
+                return
+        self.il_icall(dest_label)
+
+
+    def native_expression(self, buf, dest_label):
+        """Compile the expression at the position of line buffer `buf`, as
+        the IL subroutine at `dest_label` would parse it, into a function.
+
+        Returns (evaluate, end, calls, room, trace): the function, which
+        returns the value of the expression; the position after the
+        expression; the room the IL would need on the control and
+        expression stacks; and the trace of the expression. `evaluate()`
+        raises BadSubscript where ARRAY1 or ARRAY2 would report error 11.
+
+        Returns None for expressions that have to go through the IL, such
+        as ones with syntax errors or SP, which prints. Results are cached
+        by line text, position and subroutine until the program is
+        cleared.
+        """
+        buf.strip()
+        key = (buf.text, buf.pos, dest_label)
+        expression = self.expression_cache.get(key)
+        if expression is None:
+            if len(self.expression_cache) >= 4096:
+                self.expression_cache.clear()
+            expression = False
+            trace_buf = LineBuffer(buf.text)
+            trace_buf.pos = buf.pos
+            trace = self.trace_il(trace_buf, dest_label, subroutine=True)
+            if trace is not None:
+                function = self.expression_function(trace[0])
+                if function is not None:
+                    evaluate, room = function
+                    expression = (evaluate, trace_buf.pos, trace[1] + 2, room,
+                                  trace[0])
+            self.expression_cache[key] = expression
+        return expression or None
+
+
+    def expression_function(self, trace):
+        """Build a function from the trace of an expression, and return it
+        with the room the IL would need on the expression stack, or return
+        None if the trace does anything but compute one value.
+
+        The function is a tree of closures that evaluates operands in the
+        order the IL would. Literals and variables are read in place by the
+        operation that uses them, rather than by closures of their own.
+        """
+        v = self.basic_var_data
+        data = self.basic_array_data
+        cells = self.basic_array_cells
+        widths = self.basic_array_widths
+
+        def function(x):
+            kind, a = x
+            if kind == 'lit':
+                return lambda: a
+            if kind == 'var':
+                return lambda: v[a]
+            return a
+
+        def binary(f, x, y):
+            (x_kind, a), (y_kind, b) = x, y
+            if x_kind == 'var' and y_kind == 'lit':
+                return lambda: f(v[a], b)
+            if x_kind == 'var' and y_kind == 'var':
+                return lambda: f(v[a], v[b])
+            if x_kind == 'lit' and y_kind == 'var':
+                return lambda: f(a, v[b])
+            if x_kind == 'fn' and y_kind == 'lit':
+                return lambda: f(a(), b)
+            if x_kind == 'fn' and y_kind == 'var':
+                return lambda: f(a(), v[b])
+            a = function(x)
+            b = function(y)
+            return lambda: f(a(), b())
+
+        def neg(a):
+            return lambda: 0 - a()
+
+        def indirect(a):
+            def value():
+                i = a()
+                return v[i] if i < 26 else data[i]
+            return value
+
+        def rnd():
+            return self.random.randint(0, 10000)
+
+        def array1(var, offset):
+            def cell():
+                idx = offset()
+                idx += v[var]
+                if idx not in cells[var]:
+                    raise BadSubscript
+                return idx
+            return cell
+
+        def array2(var, x, y):
+            def cell():
+                x_idx = x()
+                y_idx = y()
+                width = widths[var]
+                idx = v[var] + (y_idx * width) + x_idx
+                if not 0 <= x_idx < width or idx not in cells[var]:
+                    raise BadSubscript
+                return idx
+            return cell
+
+        operators = {'ADD': operator.add, 'SUB': operator.sub,
+                     'MPY': operator.mul, 'DIV': operator.floordiv}
+        # Values as ('lit', value), ('var', index) or ('fn', function)
+        stack = []
+        room = 0
+        for op, args in trace:
+            if op == 'LIT' or op == 'RANDOM':
+                room = max(room, len(stack) + 1)
+            if op == 'LIT':
+                stack.append(('lit', args[0]))
+            elif op == 'RANDOM':
+                stack.append(('fn', rnd))
+            elif op == 'IND' and stack:
+                kind, a = stack.pop()
+                if kind == 'lit' and a < 26:
+                    stack.append(('var', a))
+                else:
+                    stack.append(('fn', indirect(function((kind, a)))))
+            elif op in operators and len(stack) >= 2:
+                y = stack.pop()
+                x = stack.pop()
+                stack.append(('fn', binary(operators[op], x, y)))
+            elif op == 'NEG' and stack:
+                stack.append(('fn', neg(function(stack.pop()))))
+            elif op == 'ARRAY1' and len(stack) >= 2 and stack[-2][0] == 'lit':
+                offset = function(stack.pop())
+                _, var = stack.pop()
+                stack.append(('fn', array1(var, offset)))
+            elif op == 'ARRAY2' and len(stack) >= 3 and stack[-3][0] == 'lit':
+                y = function(stack.pop())
+                x = function(stack.pop())
+                _, var = stack.pop()
+                stack.append(('fn', array2(var, x, y)))
+            else:
+                return None
+        if len(stack) != 1:
+            return None
+        return function(stack[0]), room
+
+    #
+    # Program compiler
+    #
+
+    def compile_program(self):
+        """Compile every stored line into a Python function.
+
+        Each function does what the line's trace does through `il_line()`,
+        but keeps intermediate values in Python locals rather than on the
+        expression stack. It returns True when execution leaves the program
+        (END, an error or the end of input) and None to carry on with the
+        line `basic_linenum` points at. Lines that cannot be traced or
+        compiled by Python, and lines with breakpoints, map to None and
+        are run through the IL.
+        """
+        namespace = {'tb': self}
+        compiled_lines = {}
+        for line_num in self.basic_lines:
+            text = self.basic_program[line_num]
+            if line_num in self.breakpoints:
+                trace = None
+            else:
+                trace = self.trace_line(text)
+            body = (None if trace is None
+                    else self.generate_line(trace, namespace))
+            compiled_lines[line_num] = None
+            if body is None:
+                continue
+            source = '\n'.join([f'def line_{line_num}():',
+                                *(f'    {ln}' for ln in body)])
+            try:
+                # Python's parser has limits that a BASIC line can exceed,
+                # such as deeply nested parentheses; the IL has none.
+                exec(compile(source, '<BASIC program>', 'exec'), namespace)
+            except (SyntaxError, RecursionError, MemoryError):
+                continue
+            compiled_lines[line_num] = namespace[f'line_{line_num}']
+        self.compiled_lines = compiled_lines
+
+
+    def generate_line(self, trace, namespace):
+        """Generate the body of a compiled line from its trace.
+
+        Values are tracked as Python expressions and only pushed on the
+        expression stack when the line leaves or calls a handler that
+        needs them there, such as FOR and NEXT. Pending expressions are
+        evaluated into temporaries before anything with a side effect, so
+        values are read and errors raised in the same order as in the IL.
+        Returns None if the trace uses something that cannot be compiled.
+        """
+        code = ['v = tb.basic_var_data', 'c = tb.basic_array_data',
+                'es = tb.expression_stack', 'write = tb.output.write']
+        stack = []
+        temps = []
+        # Temporaries that hold the index of an array cell
+        cell_temps = set()
+
+        def temp(expr):
+            temps.append(f't{len(temps)}')
+            code.append(f'{temps[-1]} = {expr}')
+            return temps[-1]
+
+        def pop():
+            return stack.pop() if stack else temp('es.pop()')
+
+        def take(n):
+            # Operands from both places are only read once the pending
+            # ones have been evaluated, as in the IL.
+            if len(stack) < n:
+                flush()
+            return reversed([pop() for _ in range(n)])
+
+        def spill():
+            for i, expr in enumerate(stack):
+                if not re.fullmatch(r'\d+|t\d+', expr):
+                    stack[i] = temp(expr)
+
+        def flush():
+            spill()
+            code.extend(f'es.push({expr})' for expr in stack)
+            stack.clear()
+
+        def cell(index):
+            # Where variable or array cell `index` is, as an expression
+            if index in cell_temps:
+                return f'c[{index}]'
+            if index.isdigit() and int(index) < 26:
+                return f'v[{index}]'
+            if not re.fullmatch(r't\d+', index):
+                spill()
+                index = temp(index)
+            return f'(v if {index} < 26 else c)[{index}]'
+
+        def call(op, handler, args):
+            flush()
+            namespace[f'h_{op}'] = handler
+            code.append(f'h_{op}({", ".join(map(repr, args))})')
+
+        for op, args in trace:
+            if op == 'LIT':
+                stack.append(repr(args[0]))
+            elif op == 'IND':
+                stack.append(cell(pop()))
+            elif op in ('ADD', 'SUB', 'MPY', 'DIV'):
+                operand1, operand2 = take(2)
+                operator = {'ADD': '+', 'SUB': '-', 'MPY': '*',
+                            'DIV': '//'}[op]
+                stack.append(f'({operand1} {operator} {operand2})')
+            elif op == 'NEG':
+                stack.append(f'(-{pop()})')
+            elif op == 'RANDOM':
+                spill()
+                stack.append(temp('tb.random.randint(0, 10000)'))
+            elif op == 'ARRAY1':
+                spill()
+                var, offset = take(2)
+                idx = temp(f'v[{var}] + {offset}')
+                code.append(f'if {idx} not in tb.basic_array_cells[{var}]:')
+                code.append('    tb.il_err(11)')
+                code.append('    return True')
+                cell_temps.add(idx)
+                stack.append(idx)
+            elif op == 'ARRAY2':
+                spill()
+                var, x, y = take(3)
+                idx = temp(f'v[{var}] + ({y} * tb.basic_array_widths[{var}])'
+                           f' + {x}')
+                code.append(f'if not 0 <= {x} < tb.basic_array_widths[{var}]'
+                            f' or {idx} not in tb.basic_array_cells[{var}]:')
+                code.append('    tb.il_err(11)')
+                code.append('    return True')
+                cell_temps.add(idx)
+                stack.append(idx)
+            elif op == 'STORE' or op == 'STOREV':
+                var_index, value = take(2)
+                spill()
+                code.append(f'{cell(var_index)} = {value}')
+                if op == 'STOREV':
+                    stack.append(var_index)
+            elif op == 'PRN':
+                n = pop()
+                spill()
+                code.append(f'write(str({n}))')
+            elif op in ('PRS', 'SPC', 'SPCONE', 'NLINE'):
+                spill()
+                text = {'PRS': args[0] if args else '', 'SPC': '\t',
+                        'SPCONE': ' ', 'NLINE': '\n'}[op]
+                code.append(f'write({text!r})')
+            elif op == 'CMPR':
+                operand1, operator, operand2 = take(3)
+                if operator not in ('0', '1', '2', '3', '4', '5'):
+                    return None
+                relop = ['==', '<', '<=', '!=', '>', '>='][int(operator)]
+                cmpr = temp(f'{operand1} {relop} {operand2}')
+                flush()
+                code.append(f'if not {cmpr}: return')
+            elif op == 'XINIT':
+                code.append('tb.innum_buffer = []')
+            elif op == 'INNUM':
+                # Left to the line cache, which can wait for input
+                return None
+            elif op == 'TAB':
+                call(op, self.line_tab, args)
+            elif op in ('DIM1', 'DIM2', 'NEXT', 'RSTR'):
+                call(op, self.il_ops[op], args)
+                code.append(f'if tb.pc == {self.errent_pc}: return True')
+            elif op in ('FOR', 'SAV'):
+                call(op, self.il_ops[op], args)
+            elif op == 'NXT':
+                flush()
+                code.append('return')
+            elif op == 'XFER':
+                loc = temp(pop())
+                flush()
+                code.append(f'if 1 <= {loc} < {self.max_lines}'
+                            f' and {loc} in tb.basic_program:')
+                code.append(f'    tb.basic_linenum = {loc}')
+                code.append('    return')
+                code.append("tb.basic_error('Invalid line number.', code=7)")
+                code.append('return True')
+            elif op == 'FIN':
+                call(op, self.il_fin, args)
+                code.append('return True')
+            else:
+                return None
+        return code
+
+
+    def il_run(self):
+        """Run compiled lines from `basic_linenum` until execution leaves
+        the program or reaches a line that has to go through the IL."""
+        lines = self.compiled_lines
+        order = self.basic_lines
+        while True:
+            if self.basic_linenum == 0:
+                self.pc = self.co_pc
+                return
+            i = bisect.bisect_left(order, self.basic_linenum)
+            if i == len(order):
+                self.basic_linenum = 0
+                self.pc = self.co_pc
+                return
+            line_num = order[i]
+            line = lines[line_num]
+            if line is None:
+                self.load_line(line_num)
+                return
+            self.basic_linenum = line_num + 1
+            if line():
+                return
+            if self.counting_steps:
+                self.pc = self.run_pc
+                return
+
     #########################################################################$
 
     def fail_test(self, dest_label):
-        if self.pc - 1 == self.il_labels[dest_label]:
-            print(f'Syntax error at line {self.basic_linenum - 1}.')
-            self.pc = self.il_labels['ERRENT']
+        if self.pc - 1 == dest_label:
+            self.syntax_error()
+        elif (self.superinstructions and self.profiler is None
+              and self.hooks is None):
+            # Go straight on to the instruction at `dest_label`, usually
+            # another test, rather than back through the dispatch loop.
+            self.pc = dest_label + 1
+            handler, args = self.il_program[dest_label]
+            handler(*args)
         else:
-            self.pc = self.il_labels[dest_label]
+            self.pc = dest_label
+
+
+    def syntax_error(self):
+        self.basic_error(f'Syntax error at line {self.basic_linenum - 1}.',
+                         BasicSyntaxError)
+
+
+    def basic_error(self, message, error=BasicError, code=None):
+        """Print an error message and go back to control mode, or raise
+        `error` when running headless."""
+        line = self.current_line()
+        if self.hooks is not None:
+            self.fire('error', error(message, code, line))
+        if self.headless:
+            raise error(message, code, line)
+        self.output.write(f'{message}\n')
+        self.pc = self.errent_pc
 
 
     def start(self):
-        print()
-        print(self.greeting)
-        print()
-        print('Press ^C to break and ^D to quit.')
+        self.greet()
+        self.execute()
+        self.stop()
+
+
+    def greet(self):
+        self.output.write(f'\n{self.greeting}\n\n')
+        self.output.write('Press ^C to break and ^D to quit.\n')
+
+
+    def stop(self):
+        """Finish off after execution has stopped for good."""
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.finish()
+
+
+    def execute(self, max_steps=None, timeout=None):
+        """Run the IL from `pc` until the user quits.
+
+        Given `max_steps` or `timeout` (in seconds), stop early once that
+        many steps have been executed, or that much time has passed, and
+        return 'step_limit' or 'time_limit'. Returns 'input' when it has
+        to wait for a line from an `InputQueue`, and 'breakpoint' when it
+        reaches a line in `breakpoints`.
+
+        A step is one handler called by the dispatch loop: usually an IL
+        instruction, but a superinstruction, a native expression, or a
+        replayed pre-parsed or compiled line counts as one step too. How
+        much a budget runs therefore depends on `engine`, `cache_lines`,
+        `superinstructions` and `native_expressions`. Hooks and the
+        profiler run the plain IL. With the 'il' engine and the other
+        three off, every step is one IL instruction.
+        """
+        limited = max_steps is not None or timeout is not None
+        stop_steps = math.inf if max_steps is None else self.steps + max_steps
+        deadline = math.inf if timeout is None else time.monotonic() + timeout
+        il_program = self.il_program
+        self.counting_steps = limited
+        try:
+            while not self.user_quit:
+                try:
+                    if self.profiler is not None:
+                        status = self.profiler.execute(self, stop_steps,
+                                                       deadline)
+                        if status is not None:
+                            return status
+                    elif self.hooks is not None:
+                        status = self.execute_hooked(stop_steps, deadline)
+                        if status is not None:
+                            return status
+                    elif limited:
+                        status = self.execute_limited(stop_steps, deadline)
+                        if status is not None:
+                            return status
+                    while not self.user_quit:
+                        handler, args = il_program[self.pc]
+                        self.pc += 1
+                        handler(*args)
+                except LoopChanged:
+                    pass
+                except InputNeeded:
+                    return 'input'
+                except BreakpointHit:
+                    return 'breakpoint'
+                except KeyboardInterrupt:
+                    self.pc = self.errent_pc
+                    self.basic_linenum = 0
+                except StackOverflow as e:
+                    for stack in (self.expression_stack, self.control_stack,
+                                  self.subroutine_stack, self.loop_stack):
+                        if len(stack) >= stack.max_depth:
+                            stack.clear()
+                    self.il_err(e.code)
+                except ZeroDivisionError:
+                    if not self.headless:
+                        raise
+                    self.il_err(8)
+                except OverflowError:
+                    self.il_err(2)
+        finally:
+            self.counting_steps = False
+            self.output.flush()
+        return None
+
+
+    def execute_limited(self, stop_steps, deadline):
+        """The loop of `execute()`, counting steps and checking the clock
+        every thousand steps."""
+        il_program = self.il_program
         while not self.user_quit:
+            if self.steps >= stop_steps:
+                return 'step_limit'
+            if time.monotonic() >= deadline:
+                return 'time_limit'
+            steps = self.steps
+            chunk_end = min(steps + 1000, stop_steps)
             try:
-                op = self.il_program[self.pc][0]
-                args = self.il_program[self.pc][1:]
-                self.pc += 1
-                self.il_ops[op](*args)
-            except KeyboardInterrupt:
-                self.pc = self.il_labels['ERRENT']
-                self.basic_linenum = 0
+                while steps < chunk_end and not self.user_quit:
+                    handler, args = il_program[self.pc]
+                    self.pc += 1
+                    steps += 1
+                    handler(*args)
+            finally:
+                self.steps = steps
+        return None
+
+
+    def execute_hooked(self, stop_steps, deadline):
+        """The loop of `execute()` while there are hooks, running the unfused
+        IL with `hooked_program` and calling 'op' hooks."""
+        il_program = self.hooked_program
+        opcodes = self.hook_opcodes
+        op_hooks = self.hooks.get('op')
+        while not self.user_quit:
+            if self.steps >= stop_steps:
+                return 'step_limit'
+            if time.monotonic() >= deadline:
+                return 'time_limit'
+            steps = self.steps
+            chunk_end = min(steps + 1000, stop_steps)
+            try:
+                while steps < chunk_end and not self.user_quit:
+                    pc = self.pc
+                    handler, args = il_program[pc]
+                    self.pc = pc + 1
+                    steps += 1
+                    if op_hooks:
+                        for hook in op_hooks:
+                            hook(pc, opcodes[pc])
+                    handler(*args)
+            finally:
+                self.steps = steps
+        return None
+
+
+    def reset(self, inputs=None):
+        """Forget the program, variables and pending input, so that the
+        interpreter can be reused for another program."""
+        self.il_init()
+        self.basic_linenum = 0
+        self.line_buffer_buffer = []
+        self.inputs = None if inputs is None else iter(inputs)
+        self.awaiting_input = False
+        self.user_quit = False
+        self.exit_status = None
+        self.steps = 0
+        if self.seed is not None:
+            self.random.seed(self.seed)
+
+
+    def load_program(self, text):
+        """Store the numbered lines of a BASIC program, as if they had been
+        typed at the command prompt."""
+        self.load_lines(text.splitlines())
+
+
+    def load_lines(self, lines, direct=False):
+        """Store numbered lines from an iterable of strings, such as an open
+        file, as if they had been typed at the command prompt.
+
+        Lines are taken one at a time and stored directly, rather than run
+        through the IL, and the line order is sorted out once at the end.
+        A line number on its own deletes the line. A line without a number
+        raises BasicSyntaxError, unless `direct` is set: then loading stops
+        there, and that line and the rest are returned as a list, to be
+        typed in at the prompt through `line_buffer_buffer`. Otherwise the
+        list is empty.
+        """
+        program = self.basic_program
+        lines = iter(lines)
+        try:
+            for line in lines:
+                raw_line = line
+                line = line.strip()
+                head, _, _ = line.partition(' ')
+                if head == '':
+                    continue
+                try:
+                    line_num = int(head)
+                except ValueError:
+                    if direct:
+                        return [raw_line, *lines]
+                    raise BasicSyntaxError(
+                        f'Not a numbered line: {line}') from None
+                if not 1 <= line_num < self.max_lines:
+                    raise BasicError('Invalid line number.', 7)
+                text = line[len(head):].strip()
+                if text:
+                    program[line_num] = text
+                else:
+                    program.pop(line_num, None)
+        finally:
+            self.basic_lines = sorted(program)
+            self.line_cache.clear()
+            self.compiled_lines = None
+        return []
+
+
+    def save_image(self, path, state=False):
+        """Save the stored program to file `path` as a program image, and
+        with `state`, the variables and arrays as well.
+
+        An image is `PROGRAM_IMAGE_MAGIC` followed by a marshalled dict of
+        the sorted line numbers, the line texts with the numbers already
+        split off, and the optional state, with array cells as
+        little-endian 64-bit integers. `load_image()` reads it back in one
+        read, without parsing any lines.
+        """
+        image = {'version': PROGRAM_IMAGE_VERSION,
+                 'lines': tuple(self.basic_lines),
+                 'text': '\n'.join(self.basic_program[line_num]
+                                   for line_num in self.basic_lines),
+                 'state': None}
+        if state:
+            image['state'] = {
+                'variables': list(self.basic_var_data),
+                'data': self.cell_bytes(),
+                'arrays': dict(self.basic_arrays),
+                'free': [(run.start, run.stop) for run in self.free_cells],
+            }
+        with open(path, 'wb') as f:
+            f.write(PROGRAM_IMAGE_MAGIC + marshal.dumps(image))
+
+
+    def load_image(self, path):
+        """Replace the stored program with the one in image file `path`,
+        and the variables and arrays too if the image has them. See
+        `save_image()`."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(PROGRAM_IMAGE_MAGIC):
+            raise ValueError(f'{path} is not a program image.')
+        try:
+            image = marshal.loads(data[len(PROGRAM_IMAGE_MAGIC):])
+            version = image['version']
+        except (EOFError, ValueError, TypeError, KeyError):
+            raise ValueError(f'{path} is not a program image.') from None
+        if version != PROGRAM_IMAGE_VERSION:
+            raise ValueError(f'{path} has image format {version}, '
+                             f'not {PROGRAM_IMAGE_VERSION}.')
+        self.restore_program(image['lines'], image['text'])
+        state = image['state']
+        if state is not None:
+            self.restore_cells(state['variables'], state['data'],
+                               state['arrays'], state['free'])
+
+
+    def cell_bytes(self):
+        """The array cells as little-endian 64-bit integers."""
+        data = array.array('q', self.basic_array_data)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        return data.tobytes()
+
+
+    def restore_program(self, lines, text):
+        """Replace the stored program with sorted line numbers `lines` and
+        their texts, separated by newlines in `text`."""
+        if lines and not (1 <= lines[0] and lines[-1] < self.max_lines):
+            raise BasicError('Invalid line number.', 7)
+        texts = text.split('\n') if lines else []
+        self.basic_program = dict(zip(lines, texts))
+        self.basic_lines = list(lines)
+        self.line_cache.clear()
+        self.compiled_lines = None
+
+
+    def restore_cells(self, variables, data, arrays, free):
+        """Replace the variables and arrays with `variables`, cells `data`,
+        from `cell_bytes()`, arrays by variable index as (base index,
+        dimensions) and free runs of cells as (start, stop)."""
+        data = array.array('q', data)
+        if sys.byteorder == 'big':
+            data.byteswap()
+        # Native expressions hold on to these, so update them in place.
+        self.basic_var_data[:] = variables
+        self.basic_array_data[:] = data
+        self.basic_arrays = {}
+        for var in range(26):
+            self.basic_array_widths[var] = 0
+            self.basic_array_cells[var] = range(0)
+        for var, (idx, dims) in arrays.items():
+            self.basic_arrays[var] = (idx, dims)
+            self.basic_array_widths[var] = dims[0] if len(dims) == 2 else 0
+            self.basic_array_cells[var] = range(idx, idx + math.prod(dims))
+        self.free_cells = [range(start, stop) for start, stop in free]
+        self.array_cells_used = sum(
+            len(cells) for cells in self.basic_array_cells)
+
+
+    def save_checkpoint(self, path):
+        """Save the state of the interpreter to checkpoint file `path`, so
+        that `load_checkpoint()` can carry on from here, in this process or
+        another one, with the same IL.
+
+        Call it between calls to `step()` or `execute()`, such as every few
+        seconds of a long RUN. The state saved is the position in the IL and
+        in the current line, the stacks, the variables and arrays, the
+        stored program, pending input numbers and direct statements, and the
+        state of the generator RN uses. Output, and input yet to be read,
+        are left to the caller.
+
+        The first checkpoint to a file saves everything. Later ones are
+        appended as records with only the program, if it changed, and the
+        blocks of `CHECKPOINT_BLOCK_SIZE` bytes of cells that changed since
+        the previous checkpoint, along with the rest of the state, which is
+        small. Once the appended records outgrow the first, the file is
+        rewritten with everything, to a temporary file that replaces it, so
+        a checkpoint cut short by the process being killed leaves the one
+        before it intact.
+        """
+        data = self.cell_bytes()
+        base = self.checkpoint_base
+        full = (base is None or path != self.checkpoint_path
+                or base['appended'] > base['size'])
+        program = None
+        if full or self.basic_program != base['program']:
+            program = {'lines': tuple(self.basic_lines),
+                       'text': '\n'.join(self.basic_program[line_num]
+                                         for line_num in self.basic_lines)}
+        size = CHECKPOINT_BLOCK_SIZE
+        blocks = {}
+        for i in range(0, len(data), size):
+            block = data[i:i + size]
+            if full or block != base['data'][i:i + size]:
+                blocks[i // size] = block
+        record = marshal.dumps({
+            'version': CHECKPOINT_VERSION,
+            'il': self.il_fingerprint(),
+            'program': program,
+            'cells': len(data),
+            'blocks': blocks,
+            'state': self.execution_state(),
+        })
+        record = len(record).to_bytes(8, 'little') + record
+        if full:
+            temp_path = f'{path}.{os.getpid()}'
+            with open(temp_path, 'wb') as f:
+                f.write(CHECKPOINT_MAGIC + record)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+            base = {'size': len(record), 'appended': 0}
+        else:
+            with open(path, 'ab') as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            base['appended'] += len(record)
+        base['program'] = dict(self.basic_program)
+        base['data'] = data
+        self.checkpoint_path = path
+        self.checkpoint_base = base
+
+
+    def il_fingerprint(self):
+        """A hash of the assembled IL, which IL addresses depend on."""
+        return self.il_image.fingerprint
+
+
+    def execution_state(self):
+        """The state saved by `save_checkpoint()` apart from the program
+        and cells, as marshallable values."""
+        if self.pc == self.line_pc:
+            # Replaying a cached line, from the action the line had got to
+            actions = self.line_cache[self.basic_linenum - 1]
+            pc = ('line', len(actions) - len(self.line_actions))
+        elif self.pc == self.run_pc:
+            pc = ('run', 0)
+        else:
+            pc = ('il', self.pc)
+        buf = self.line_buffer
+        return {
+            'pc': pc,
+            'basic_linenum': self.basic_linenum,
+            'line_buffer': (buf.text, buf.pos, buf.end, buf.stripped),
+            'expression_stack': list(self.expression_stack),
+            'control_stack': list(self.control_stack),
+            'subroutine_stack': list(self.subroutine_stack),
+            'loop_stack': list(self.loop_stack),
+            'variables': list(self.basic_var_data),
+            'arrays': dict(self.basic_arrays),
+            'free': [(run.start, run.stop) for run in self.free_cells],
+            'innum_buffer': list(self.innum_buffer),
+            'line_buffer_buffer': list(self.line_buffer_buffer),
+            'awaiting_input': self.awaiting_input,
+            'user_quit': self.user_quit,
+            'exit_status': self.exit_status,
+            'steps': self.steps,
+            'random': self.random.getstate(),
+        }
+
+
+    def load_checkpoint(self, path):
+        """Restore the state saved in checkpoint file `path` by
+        `save_checkpoint()`, ready for `step()` or `execute()` to carry on.
+
+        The interpreter must run the same IL as the one that saved it. A
+        record cut short at the end of the file is ignored. RN carries on
+        from the saved state of its generator, on a generator of this
+        interpreter's own.
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(CHECKPOINT_MAGIC):
+            raise ValueError(f'{path} is not a checkpoint.')
+        fingerprint = self.il_fingerprint()
+        pos = len(CHECKPOINT_MAGIC)
+        program = cells = state = None
+        while pos + 8 <= len(data):
+            length = int.from_bytes(data[pos:pos + 8], 'little')
+            if pos + 8 + length > len(data):
+                break
+            try:
+                record = marshal.loads(data[pos + 8:pos + 8 + length])
+                version = record['version']
+            except (EOFError, ValueError, TypeError, KeyError):
+                raise ValueError(f'{path} is not a checkpoint.') from None
+            if version != CHECKPOINT_VERSION:
+                raise ValueError(f'{path} has checkpoint format {version}, '
+                                 f'not {CHECKPOINT_VERSION}.')
+            if record['il'] != fingerprint:
+                raise ValueError(f'{path} was saved with a different IL '
+                                 f'program.')
+            if record['program'] is not None:
+                program = record['program']
+            if cells is None:
+                cells = bytearray(record['cells'])
+            else:
+                del cells[record['cells']:]
+                cells.extend(bytes(record['cells'] - len(cells)))
+            size = CHECKPOINT_BLOCK_SIZE
+            for i, block in record['blocks'].items():
+                cells[i * size:i * size + len(block)] = block
+            state = record['state']
+            pos += 8 + length
+        if state is None:
+            raise ValueError(f'{path} is not a checkpoint.')
+
+        self.restore_program(program['lines'], program['text'])
+        self.restore_cells(state['variables'], cells, state['arrays'],
+                           state['free'])
+        self.expression_cache.clear()
+        for name in ('expression_stack', 'control_stack', 'subroutine_stack',
+                     'loop_stack'):
+            stack = getattr(self, name)
+            stack.clear()
+            stack.extend(state[name])
+        text, pos, end, stripped = state['line_buffer']
+        self.line_buffer.reset(text)
+        self.line_buffer.pos = pos
+        self.line_buffer.end = end
+        self.line_buffer.stripped = stripped
+        self.basic_linenum = state['basic_linenum']
+        self.innum_buffer = list(state['innum_buffer'])
+        self.line_buffer_buffer = list(state['line_buffer_buffer'])
+        self.awaiting_input = state['awaiting_input']
+        self.user_quit = state['user_quit']
+        self.exit_status = state['exit_status']
+        self.steps = state['steps']
+        self.error = None
+        self.random = random.Random()
+        self.random.setstate(state['random'])
+
+        kind, pc = state['pc']
+        if kind == 'line':
+            line_num = self.basic_linenum - 1
+            actions = self.compile_line(self.basic_program[line_num]) or ()
+            self.line_cache[line_num] = actions
+            self.line_actions = actions[pc:]
+            self.pc = self.line_pc
+        elif kind == 'run':
+            if self.engine == 'compiled':
+                self.compile_program()
+                self.pc = self.run_pc
+            else:
+                self.il_nxt()
+        else:
+            self.pc = pc
+        self.checkpoint_path = None
+        self.checkpoint_base = None
+
+
+    def run_program(self, max_steps=None, timeout=None):
+        """RUN the stored program and return when execution stops.
+
+        Returns the status from `execute()`.
+        """
+        self.start_program()
+        return self.execute(max_steps, timeout)
+
+
+    def start_program(self):
+        """Set up to RUN the stored program from the next `execute()` or
+        `step()`."""
+        self.line_buffer.reset('')
+        self.pc = self.xec_pc
+        self.user_quit = False
+        self.error = None
+
+
+    def step(self, max_instructions=None, timeout=None):
+        """Execute at most `max_instructions` steps, as `execute()` counts
+        them, for at most `timeout` seconds, and return why execution
+        stopped:
+
+        'input'       waiting for a line from an `InputQueue`
+        'finished'    the session is over
+        'error'       a headless interpreter raised `error`
+        'step_limit'  the step budget is used up
+        'time_limit'  the watchdog timeout has passed
+        'breakpoint'  the line about to run has a breakpoint
+
+        Calling `step()` again carries on from where it stopped. Without a
+        budget or timeout, execution runs at full speed.
+        """
+        if self.user_quit:
+            return 'finished'
+        try:
+            status = self.execute(max_instructions, timeout)
+        except BasicError as e:
+            self.error = e
+            self.user_quit = True
+            return 'error'
+        return status or 'finished'
+
+
+    def run_until(self, lines=(), max_instructions=None, timeout=None):
+        """Like `step()`, but also stop before running any of the stored
+        `lines`, as if they had breakpoints."""
+        breakpoints = self.breakpoints
+        self.set_breakpoints(breakpoints | set(lines))
+        try:
+            return self.step(max_instructions, timeout)
+        finally:
+            self.set_breakpoints(breakpoints)
+
+
+    def set_breakpoints(self, lines):
+        """Stop `execute()` before running any of the stored `lines`."""
+        lines = frozenset(lines)
+        if lines == self.breakpoints:
+            return
+        self.breakpoints = lines
+        if self.compiled_lines is not None:
+            self.compile_program()
+
+
+    def run(self, program_text, inputs=(), max_steps=None, timeout=None):
+        """Reset a headless interpreter, run a BASIC program on it and
+        return a `RunResult`. See the module-level `run()`."""
+        chunks = []
+        self.output = Output(chunks.append)
+        self.reset(inputs)
+        # Steps are only counted with a budget.
+        limited = max_steps is not None or timeout is not None
+        try:
+            self.load_program(program_text)
+            status = self.run_program(max_steps, timeout)
+        except Exception as e:
+            e.output = ''.join(chunks)
+            e.steps = self.steps if limited else None
+            raise
+        return RunResult(''.join(chunks), self.variables(), self.arrays(),
+                         status or self.exit_status or 'done',
+                         self.steps if limited else None)
+
+
+    def variables(self):
+        """Return the values of the variables A-Z by name.
+
+        Variables with an array are left out, as they only hold where the
+        array's cells start; see `arrays()` for those.
+        """
+        return {chr(ord('A') + i): self.basic_var_data[i] for i in range(26)
+                if i not in self.basic_arrays}
+
+
+    def arrays(self):
+        """Return the contents of dimensioned arrays by name.
+
+        A one-dimensional array is a list and a two-dimensional array is a
+        list of columns, so that `arrays()['A'][x][y]` is `A(x,y)`.
+        """
+        data = self.basic_array_data
+        arrays = {}
+        for var, (idx, dims) in sorted(self.basic_arrays.items()):
+            if len(dims) == 1:
+                array = data[idx:idx + dims[0]].tolist()
+            else:
+                x_size, y_size = dims
+                array = [data[idx + x:idx + x_size * y_size:x_size].tolist()
+                         for x in range(x_size)]
+            arrays[chr(ord('A') + var)] = array
+        return arrays
+
+
+IL_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Constructor arguments for each BASIC dialect
+dialects = {
+    'tb': {
+        'il_code': os.path.join(IL_DIR, 'tinybasic.il'),
+        'max_lines': 2**8,
+        'greeting': '''Tiny BASIC
+
+As published in Dr Dobb's Journal of Computer Calisthenics
+    and Orthodontia, Vol.1, No.1 (1976).''',
+        'command_prompt': '? ',
+        'input_prompt': '# ',
+        'enable_multistatement': False,
+    },
+    'tbx': {
+        'il_code': os.path.join(IL_DIR, 'tbx.il'),
+        'max_lines': 2**16,
+        'greeting': '''Tiny BASIC Extended (TBX)
+
+As published in Dr Dobb's Journal of Computer Calisthenics
+    and Orthodontia, Vol.1, Nos.1-2 (1976).''',
+        'command_prompt': ': ',
+        'input_prompt': '? ',
+        'enable_multistatement': True,
+    },
+}
+
+RunResult = collections.namedtuple('RunResult',
+                                   'output variables arrays status steps')
+
+
+def headless_interpreter(dialect='tbx', **kwargs):
+    """Create a headless interpreter for `dialect`."""
+    if dialect not in dialects:
+        raise ValueError(f'Unknown dialect {dialect!r}.')
+    return TinyBasicInterpreter(**dict(dialects[dialect], headless=True,
+                                       **kwargs))
+
+
+def run(program_text, inputs=(), dialect='tbx', max_steps=None, timeout=None,
+        cache=None, **kwargs):
+    """Run a BASIC program without a terminal and return a `RunResult`.
+
+    The program is stored and RUN without a greeting, prompts or echo.
+    INPUT statements read from `inputs`, an iterable of numbers or lines of
+    comma-separated numbers. The result holds everything the program
+    printed, the final `variables()` and `arrays()`, the exit status and
+    the number of steps counted, as `execute()` counts them. Steps are
+    only counted with `max_steps` or `timeout`, and are None otherwise.
+    The status is 'end' if the program executed END, 'done' if it ran
+    past its last line, or 'step_limit' or 'time_limit' if it ran out of
+    `max_steps` or `timeout` (in seconds).
+    Errors raise `BasicError` or one of its subclasses, with the output
+    printed so far in its `output` attribute. Given a `ResultCache` as
+    `cache`, the result may come from there instead.
+
+    Other keyword arguments are passed on to `TinyBasicInterpreter`.
+    """
+    tb = headless_interpreter(dialect, **kwargs)
+    if cache is not None:
+        return cache.run(tb, program_text, inputs, max_steps, timeout)
+    return tb.run(program_text, inputs, max_steps, timeout)
+
+#
+# Result cache
+#
+
+class RandomRecorder:
+    """Passes RN's calls on to a random number generator, noting that
+    there were any."""
+
+    def __init__(self, random):
+        self.random = random
+        self.used = False
+
+    def randint(self, a, b):
+        self.used = True
+        return self.random.randint(a, b)
+
+    def __getattr__(self, name):
+        return getattr(self.random, name)
+
+
+class ResultCache:
+    """An on-disk cache of the results of headless runs, for programs that
+    are run again and again with the same input.
+
+    Results are files in `directory`, named by a hash of the stored
+    program, with line numbers split off and lines in order, the IL, the
+    interpreter options that affect what a program does, `max_steps`,
+    whether there is a timeout and the input lines. The options include
+    the engine and optimizations, which change how far `max_steps` goes,
+    and a timeout means that steps are counted. A hit returns the recorded
+    `RunResult`, or raises the recorded `BasicError`, without running
+    anything. Runs are not recorded if their inputs are not a list or
+    tuple, if they hit their timeout, or if they use RN on an interpreter
+    without a `seed`. Interpreters with hooks or a profiler always run,
+    so that these see the run. Once the files take more than
+    `max_bytes`, the least recently used ones are removed.
+    """
+
+    def __init__(self, directory, max_bytes=2**26):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(entry.stat().st_size
+                        for entry in os.scandir(directory)
+                        if entry.name.endswith('.result'))
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.evictions = 0
+
+
+    def stats(self):
+        """Return the hit, miss, bypass and eviction counts of this cache
+        object, and the size of the store in bytes."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'bypasses': self.bypasses, 'evictions': self.evictions,
+                'bytes': self.size}
+
+
+    def key(self, tb, program_text, inputs, max_steps, timeout=None):
+        """The hash that a run's result is recorded under."""
+        tb.reset()
+        tb.load_program(program_text)
+        program = '\n'.join(f'{line_num} {tb.basic_program[line_num]}'
+                            for line_num in tb.basic_lines)
+        # Besides what a program can do, the engine and optimizations
+        # decide how far a step budget goes; see `execute()`.
+        options = (tb.max_lines, tb.enable_multistatement,
+                   tb.expression_stack.max_depth, tb.control_stack.max_depth,
+                   tb.subroutine_stack.max_depth, tb.max_array_cells, tb.seed,
+                   tb.engine, tb.cache_lines, tb.superinstructions,
+                   tb.native_expressions, sorted(tb.breakpoints))
+        key = repr((RESULT_CACHE_VERSION, tb.il_fingerprint(), options,
+                    max_steps, timeout is not None, program, inputs))
+        return hashlib.sha256(key.encode()).hexdigest()
+
+
+    def run(self, tb, program_text, inputs=(), max_steps=None, timeout=None):
+        """Return `tb.run()` of the program, from the cache if possible."""
+        if (not isinstance(inputs, (list, tuple)) or tb.hooks is not None
+                or tb.profiler is not None):
+            self.bypasses += 1
+            return tb.run(program_text, inputs, max_steps, timeout)
+        inputs = tuple(str(line) for line in inputs)
+        try:
+            key = self.key(tb, program_text, inputs, max_steps, timeout)
+        except BasicError:
+            self.bypasses += 1
+            return tb.run(program_text, inputs, max_steps, timeout)
+        path = os.path.join(self.directory, f'{key}.result')
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.loads(f.read())
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            entry = None
+        if entry is not None:
+            self.hits += 1
+            if 'error' in entry:
+                name, message, code, line = entry['error']
+                error = basic_errors[name](message, code, line)
+                error.output = entry['output']
+                error.steps = entry['steps']
+                raise error
+            return RunResult(entry['output'], entry['variables'],
+                             entry['arrays'], entry['status'], entry['steps'])
+
+        self.misses += 1
+        recorder = None
+        if tb.seed is None:
+            tb.random = recorder = RandomRecorder(tb.random)
+        try:
+            result = tb.run(program_text, inputs, max_steps, timeout)
+            entry = result._asdict()
+        except BasicError as e:
+            entry = {'error': (type(e).__name__, e.message, e.code, e.line),
+                     'output': e.output, 'steps': e.steps}
+            result = e
+        finally:
+            if recorder is not None:
+                tb.random = recorder.random
+        if ((recorder is not None and recorder.used)
+                or entry.get('status') == 'time_limit'):
+            self.bypasses += 1
+        else:
+            self.store(path, marshal.dumps(entry))
+        if isinstance(result, BasicError):
+            raise result
+        return result
+
+
+    def store(self, path, data):
+        """Write a result file, then evict old results if there are too
+        many."""
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.evict()
+
+
+    def evict(self):
+        """Remove the least recently used results until the store is down
+        to three quarters of `max_bytes`."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.result'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+#
+# Batch runner
+#
+
+def find_jobs(path):
+    """List the jobs for `run_batch()` in a directory or manifest.
+
+    A directory holds `.bas` programs, each with an optional file of input
+    lines with the same name ending in `.in`. A manifest is a text file
+    listing one program per line, optionally followed by its input file.
+    Fields are split as by a shell, so paths with spaces can be quoted;
+    relative paths are relative to the manifest, and blank lines and
+    comments starting with `#` are skipped.
+    """
+    if os.path.isdir(path):
+        entries = []
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.bas'):
+                program = os.path.join(path, name)
+                inputs = program[:-len('.bas')] + '.in'
+                entries.append((program,
+                                inputs if os.path.exists(inputs) else None))
+    else:
+        base = os.path.dirname(path)
+        entries = []
+        with open(path) as f:
+            for ln_num, line in enumerate(f, start=1):
+                try:
+                    fields = shlex.split(line, comments=True)
+                except ValueError as e:
+                    raise ValueError(f'{path}:{ln_num}: {e}.') from None
+                if not fields:
+                    continue
+                if len(fields) > 2:
+                    raise ValueError(f'{path}:{ln_num}: expected a program '
+                                     f'and an input file, got {len(fields)} '
+                                     f'fields.')
+                program = os.path.join(base, fields[0])
+                inputs = (os.path.join(base, fields[1]) if len(fields) > 1
+                          else None)
+                entries.append((program, inputs))
+    jobs = []
+    for program, inputs in entries:
+        with open(program) as f:
+            program_text = f.read()
+        input_lines = []
+        if inputs is not None:
+            with open(inputs) as f:
+                input_lines = f.read().splitlines()
+        jobs.append({'name': program, 'program': program_text,
+                     'inputs': input_lines})
+    return jobs
+
+
+# The headless interpreter and result cache of a batch worker, which is a
+# process, or a thread of this one; see `run_batch()`.
+batch_worker = threading.local()
+
+
+def batch_init(dialect, kwargs, cache_dir=None):
+    batch_worker.interpreter = headless_interpreter(dialect, **kwargs)
+    batch_worker.cache = None if cache_dir is None else ResultCache(cache_dir)
+
+
+def batch_job(job, max_steps, timeout):
+    """Run one job on this worker's interpreter and return its result."""
+    start = time.perf_counter()
+    tb = batch_worker.interpreter
+    cache = batch_worker.cache
+    result = {'name': job['name']}
+    hits = cache.hits if cache is not None else 0
+    try:
+        if cache is not None:
+            run_result = cache.run(tb, job['program'], job['inputs'],
+                                   max_steps, timeout)
+        else:
+            run_result = tb.run(job['program'], job['inputs'], max_steps,
+                                timeout)
+        result['status'] = run_result.status
+        result['output'] = run_result.output
+        result['steps'] = run_result.steps
+    except BasicError as e:
+        result['status'] = 'error'
+        result['output'] = getattr(e, 'output', '')
+        result['error'] = e.message
+        result['code'] = e.code
+        result['line'] = e.line
+        result['steps'] = getattr(e, 'steps', None)
+    except Exception as e:
+        result['status'] = 'crash'
+        result['output'] = getattr(e, 'output', '')
+        result['error'] = f'{type(e).__name__}: {e}'
+        result['steps'] = getattr(e, 'steps', None)
+    if cache is not None:
+        result['cached'] = cache.hits > hits
+    result['time'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(jobs, dialect='tbx', workers=None, max_steps=None, timeout=None,
+              cache_dir=None, threads=False, **kwargs):
+    """Run jobs across a pool of worker processes and yield their results.
+
+    Each job is a dict with the `name`, `program` text and `inputs` of a
+    program, as returned by `find_jobs()`. Every worker loads the IL once
+    and reuses one headless interpreter for all of its jobs, each of which
+    gets `max_steps` steps, as `execute()` counts them, and `timeout`
+    seconds. Results are yielded in job order as dicts with the job's
+    `name`, `status`, `output`, `steps` and `time`. The status and steps
+    are those of `run()`, or the status is 'error' with the `error`
+    message, `code` and `line`, or 'crash' if the interpreter itself
+    failed. Given `cache_dir`, workers share a `ResultCache` there, and
+    results say whether they were `cached`. Other keyword arguments are
+    passed on to `TinyBasicInterpreter`.
+
+    With `threads`, the workers are threads of this process instead. Their
+    interpreters share one ILImage, so each costs little to start and to
+    keep, and jobs need no pickling, but they only run in parallel on a
+    Python without the global interpreter lock.
+    """
+    jobs = list(jobs)
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(jobs) // (workers * 4))
+    executor = (concurrent.futures.ThreadPoolExecutor if threads
+                else concurrent.futures.ProcessPoolExecutor)
+    with executor(workers, initializer=batch_init,
+                  initargs=(dialect, kwargs, cache_dir)) as pool:
+        yield from pool.map(batch_job, jobs, [max_steps] * len(jobs),
+                            [timeout] * len(jobs), chunksize=chunksize)
+
+
+#
+# Session server
+#
+
+async def serve_session(reader, writer, dialect='tbx', slice_steps=1000,
+                        **kwargs):
+    """Run an interactive session over an asyncio stream pair.
+
+    The interpreter runs `slice_steps` steps at a time, yielding to the
+    event loop in between, and waits for lines from `reader` whenever it
+    needs input. Other keyword arguments are passed on to
+    `TinyBasicInterpreter`.
+    """
+    queue = InputQueue()
+    tb = TinyBasicInterpreter(**dict(
+        dialects[dialect], inputs=queue,
+        output=lambda text: writer.write(text.encode()), **kwargs))
+    try:
+        tb.greet()
+        while not tb.user_quit:
+            try:
+                status = tb.execute(slice_steps)
+            except Exception as e:
+                tb.output.write(f'{type(e).__name__}: {e}\n')
+                tb.output.flush()
+                break
+            await writer.drain()
+            if status == 'input':
+                line = await reader.readline()
+                if line:
+                    queue.put(line.decode(errors='replace').rstrip('\r\n'))
+                else:
+                    queue.close()
+            elif status == 'step_limit':
+                if reader.at_eof() or writer.is_closing():
+                    break
+                await asyncio.sleep(0)
+        tb.stop()
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host='127.0.0.1', port=2323, path=None, dialect='tbx',
+                slice_steps=1000, **kwargs):
+    """Serve interactive sessions on a TCP port, or on the Unix socket at
+    `path` if given, until cancelled. See `serve_session()`."""
+    async def session(reader, writer):
+        await serve_session(reader, writer, dialect, slice_steps, **kwargs)
+
+    if path is not None:
+        server = await asyncio.start_unix_server(session, path)
+    else:
+        server = await asyncio.start_server(session, host, port)
+    async with server:
+        await server.serve_forever()
 
 
 if __name__ == '__main__':
@@ -625,40 +3440,136 @@ if __name__ == '__main__':
     parser.add_argument('-x', '--extended', action='store_true', default=False,
                         help='use Tiny BASIC Extended (TBX)')
     parser.add_argument('-f', '--file', default=None,
-                        help='a BASIC program to load on start')
+                        help='a BASIC program, or program image, to load on '
+                             'start')
+    parser.add_argument('-c', '--compile', action='store_true', default=False,
+                        help='compile the program to Python when it is RUN')
+    parser.add_argument('-o', '--output', default=None,
+                        help='write program output to a file')
+    parser.add_argument('--max-lines', type=int, default=None, metavar='N',
+                        help='allow line numbers below N (default: 256, or '
+                             '65536 with -x)')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed the random numbers of RN, so that runs '
+                             'repeat')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='print a profile of each RUN to standard error')
+    parser.add_argument('--profile-sample', type=int, default=1, metavar='N',
+                        help='profile about one in N IL instructions')
+    parser.add_argument('--profile-json', default=None, metavar='FILE',
+                        help='also write the profile of each RUN to a file '
+                             'as JSON')
+    subparsers = parser.add_subparsers(dest='command')
+    batch_parser = subparsers.add_parser(
+        'batch', help='run many programs in parallel, printing JSON lines')
+    batch_parser.add_argument('paths', nargs='+',
+                              help='directories of .bas files, or manifests')
+    batch_parser.add_argument('-j', '--jobs', type=int, default=None,
+                              help='number of worker processes')
+    batch_parser.add_argument('--threads', action='store_true', default=False,
+                              help='run the workers as threads of one '
+                                   'process')
+    batch_parser.add_argument('--max-steps', type=int, default=None,
+                              help='step budget for each program; how far '
+                                   'it goes depends on the engine and '
+                                   'optimizations')
+    batch_parser.add_argument('--timeout', type=float, default=None,
+                              help='time budget for each program, in seconds')
+    batch_parser.add_argument('--cache', default=None, metavar='DIR',
+                              help='reuse the results of identical runs, '
+                                   'kept in DIR')
+    image_parser = subparsers.add_parser(
+        'image', help='save a BASIC program as a program image')
+    image_parser.add_argument('program', help='the BASIC program')
+    image_parser.add_argument('image', help='the image file to write')
+    serve_parser = subparsers.add_parser(
+        'serve', help='serve interactive sessions over a socket')
+    serve_parser.add_argument('--host', default='127.0.0.1',
+                              help='address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('--port', type=int, default=2323,
+                              help='TCP port to listen on (default: 2323)')
+    serve_parser.add_argument('--unix', default=None, metavar='PATH',
+                              help='listen on a Unix socket instead')
+    serve_parser.add_argument('--slice', type=int, default=1000, metavar='N',
+                              help='steps a session runs before letting '
+                                   'others run (default: 1000)')
     args = parser.parse_args()
 
-    autoload = []
-    if args.file is not None:
-        with open(args.file) as f:
-            autoload = list(f.readlines())
+    options = {}
+    if args.compile:
+        options['engine'] = 'compiled'
+    if args.max_lines is not None:
+        if args.max_lines < 2:
+            parser.error('--max-lines must be at least 2')
+        options['max_lines'] = args.max_lines
+    if args.seed is not None:
+        options['seed'] = args.seed
+
+    if args.command == 'serve':
+        try:
+            asyncio.run(serve(args.host, args.port, args.unix,
+                              'tbx' if args.extended else 'tb', args.slice,
+                              **options))
+        except KeyboardInterrupt:
+            pass
+        sys.exit()
 
-    if args.extended:
-        kwargs = {
-            'il_code': 'tbx.il',
-            'max_lines': 2**16,
-            'greeting': '''Tiny BASIC Extended (TBX)
+    if args.command == 'batch':
+        import json
 
-As published in Dr Dobb's Journal of Computer Calisthenics
-    and Orthodontia, Vol.1, Nos.1-2 (1976).''',
-            'command_prompt': ': ',
-            'input_prompt': '? ',
-            'enable_multistatement': True,
-            'autoload': autoload
-        }
-    else:
-        kwargs = {
-            'il_code': 'tinybasic.il',
-            'max_lines': 2**8,
-            'greeting': '''Tiny BASIC
+        try:
+            jobs = [job for path in args.paths for job in find_jobs(path)]
+        except ValueError as e:
+            sys.exit(str(e))
+        results = run_batch(jobs, 'tbx' if args.extended else 'tb',
+                            args.jobs, args.max_steps, args.timeout,
+                            args.cache, args.threads, **options)
+        output = sys.stdout if args.output is None else open(args.output, 'w')
+        with output:
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+        sys.exit()
+
+    if args.command == 'image':
+        tb = headless_interpreter('tbx' if args.extended else 'tb', **options)
+        try:
+            with open(args.program) as f:
+                tb.load_lines(f)
+        except BasicError as e:
+            sys.exit(f'{args.program}: {e}')
+        tb.save_image(args.image)
+        sys.exit()
 
-As published in Dr Dobb's Journal of Computer Calisthenics
-    and Orthodontia, Vol.1, No.1 (1976).''',
-            'command_prompt': '? ',
-            'input_prompt': '# ',
-            'enable_multistatement': False,
-            'autoload': autoload
-        }
+    kwargs = dict(dialects['tbx' if args.extended else 'tb'], **options)
+
+    def print_profile(profiler):
+        sys.stderr.write(profiler.report())
+        if args.profile_json is not None:
+            import json
+
+            with open(args.profile_json, 'w') as f:
+                json.dump(profiler.summary(), f, indent=2)
 
-    tb = TinyBasicInterpreter(**kwargs)
+    output = None if args.output is None else open(args.output, 'w')
+    tb = TinyBasicInterpreter(output=output, **kwargs)
+    if args.file is not None:
+        try:
+            with open(args.file, 'rb') as f:
+                magic = f.read(len(PROGRAM_IMAGE_MAGIC))
+            is_image = magic == PROGRAM_IMAGE_MAGIC
+            if is_image:
+                tb.load_image(args.file)
+            else:
+                # Direct statements, such as a RUN at the end, are typed in
+                # at the prompt.
+                with open(args.file) as f:
+                    tb.line_buffer_buffer = tb.load_lines(f, direct=True)
+        except (BasicError, ValueError) as e:
+            sys.exit(f'{args.file}: {e}')
+        # Skip INIT, which would forget the program.
+        tb.pc = tb.errent_pc
+    if args.profile or args.profile_json is not None:
+        tb.profile(args.profile_sample, print_profile)
     tb.start()
+    if output is not None:
+        output.close()